@@ -0,0 +1,122 @@
+"""Message chunking on large synthetic replies: previous splitter vs chunker.iter_discord_chunks.
+
+Usage: python bench/bench_chunker.py [--size-mb 2] [--runs 3]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from chunker import plan_reply, split_message # noqa: E402
+
+
+def legacy_split(msg, chunk_limit=1990):
+    """The splitter app.py used before chunker.py, kept here as the baseline."""
+    chunks = []
+    current_chunk = ""
+    in_code_block = False
+    code_block_delimiter = ""
+    for line in msg.split('\n'):
+        stripped_line = line.strip()
+        if stripped_line.startswith("```") and len(stripped_line) > 3:
+            if not in_code_block:
+                in_code_block = True
+                code_block_delimiter = stripped_line
+            elif in_code_block and stripped_line == code_block_delimiter:
+                in_code_block = False
+        elif stripped_line == "```":
+            if in_code_block:
+                in_code_block = False
+            else:
+                in_code_block = True
+                code_block_delimiter = "```"
+        if len(current_chunk) + len(line) + 1 > chunk_limit:
+            if in_code_block:
+                if not current_chunk.endswith("\n```"):
+                    current_chunk += "\n```"
+                chunks.append(current_chunk)
+                current_chunk = code_block_delimiter + "\n" + line
+            else:
+                chunks.append(current_chunk)
+                current_chunk = line
+        else:
+            if current_chunk or line.strip():
+                current_chunk += line + "\n"
+    if current_chunk:
+        if in_code_block and not current_chunk.strip().endswith("```"):
+            current_chunk += "\n```"
+        chunks.append(current_chunk.strip())
+    return [chunk for chunk in chunks if chunk]
+
+
+def directory_listing(size, rng):
+    lines = []
+    total = 0
+    while total < size:
+        line = (f"-a----   2024-0{rng.randint(1, 9)}-{rng.randint(10, 28)}  {rng.randint(10, 23)}:{rng.randint(10, 59)}"
+                f"  {rng.randint(0, 10 ** 7):>10}  file_{rng.randint(0, 10 ** 6)}.{rng.choice(['txt', 'log', 'py', 'dll'])}")
+        lines.append(line)
+        total += len(line) + 1
+    return '\n'.join(lines)
+
+
+def fenced_code(size, rng):
+    parts = []
+    total = 0
+    while total < size:
+        body = '\n'.join(f"    value_{i} = compute({rng.randint(0, 999)})  # step {i}" for i in range(rng.randint(20, 200)))
+        block = f"Here is part {len(parts)}:\n```python\n{body}\n```\n"
+        parts.append(block)
+        total += len(block)
+    return ''.join(parts)
+
+
+def single_line(size, rng):
+    return ''.join(rng.choice('abcdefghij ') for _ in range(size))
+
+
+def unbalanced_fences(chunks):
+    return sum(1 for chunk in chunks if sum(1 for line in chunk.split('\n') if line.strip().startswith('```')) % 2)
+
+
+def measure(split, text, runs):
+    best = float('inf')
+    chunks = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        chunks = split(text)
+        best = min(best, time.perf_counter() - started)
+    return best, chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=float, default=2.0)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+    rng = random.Random(7)
+    size = int(args.size_mb * 1024 * 1024)
+    inputs = {
+        'dir listing': directory_listing(size, rng),
+        'fenced code': fenced_code(size, rng),
+        'single line': single_line(min(size, 256 * 1024), rng),
+    }
+    for name, text in inputs.items():
+        print(f"{name} ({len(text) / 1e6:.2f} MB)")
+        for label, split in (('legacy', legacy_split), ('chunker', split_message)):
+            elapsed, chunks = measure(split, text, args.runs)
+            too_long = sum(1 for chunk in chunks if len(chunk) > 2000)
+            print(f"  {label:<8} {elapsed * 1000:9.1f} ms  chunks={len(chunks):<6} "
+                  f"over 2000 chars={too_long:<4} unbalanced fences={unbalanced_fences(chunks)}")
+        started = time.perf_counter()
+        plan = plan_reply(text)
+        elapsed = time.perf_counter() - started
+        print(f"  plan_reply {elapsed * 1000:7.1f} ms  -> 1 message + {plan.filename} "
+              f"({len(plan.attachment) / 1e3:.0f} KB, {len(text) / max(1, len(plan.attachment)):.1f}x smaller)")
+
+
+if __name__ == '__main__':
+    main()
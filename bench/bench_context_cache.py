@@ -0,0 +1,83 @@
+"""Prompt tokens sent with and without context caching of the static prefix.
+
+Drives ``AsyncGemini`` over a ``GeminiPool`` of stub keys, with ``PrefixCache``
+and the offline ``LocalStubProvider`` (caching enabled), the way the bot
+does: the static prefix is config/prompt.ini plus the terminal-mode
+instructions, and each request adds its own dynamic part. Checks that the
+prefix is registered once per key, that every call goes through the pool
+and uses its key's cached prefix, and that requests send fewer prompt
+tokens than the inline prompt. Exits with status 1 if any check fails.
+
+Usage: python bench/bench_context_cache.py [--requests 6] [--keys 2] [--min-tokens 0]
+"""
+import argparse
+import asyncio
+import configparser
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) # config/ relative paths
+
+from context_cache import LocalStubProvider, PrefixCache # noqa: E402
+from gemini_pool import GeminiPool # noqa: E402
+from llm_client import AsyncGemini # noqa: E402
+from prompt_builder import PromptBudget, build_prompt, build_static_prefix, estimate_tokens # noqa: E402
+from terminal_plan import plan_instructions # noqa: E402
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=6)
+    parser.add_argument('--keys', type=int, default=2)
+    parser.add_argument('--min-tokens', type=int, default=0, help="[CONTEXT_CACHE] min_tokens to test with")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('config/prompt.ini', encoding='utf-8')
+    budget = PromptBudget()
+    system_prompt = config.get('PROMPT', 'content', fallback="You are UniUI, a helpful Discord bot.")
+    static_prefix = build_static_prefix(budget, system_prompt, plan_instructions('Linux', 'bash'))
+
+    provider = LocalStubProvider()
+    # Uncached models record their calls with prefix None
+    pool = GeminiPool([f'stub-key-{i}' for i in range(args.keys)], ['stub-model'],
+                      model_factory=lambda key, name: LocalStubProvider._Model(provider, None))
+    gemini = AsyncGemini(pool=pool)
+    cache = PrefixCache(provider, gemini.run, min_tokens=args.min_tokens, enabled=True)
+
+    failures = []
+    inline = []
+    for index in range(args.requests):
+        dynamic_prompt, _ = build_prompt(budget, "User: bench-user", [], "", "",
+                                         f"Request {index}: list the files in the current directory.", "bench-user")
+        await gemini.generate_content(dynamic_prompt, prefix=static_prefix, prefix_cache=cache)
+        inline.append(estimate_tokens(f"{static_prefix}\n{dynamic_prompt}"))
+        if provider.calls[-1][0] != static_prefix:
+            failures.append(f"request {index + 1} did not use a cached prefix")
+    gemini.shutdown()
+
+    sent = [estimate_tokens(contents) for _, contents in provider.calls]
+    routes_used = sum(1 for requests, _ in pool.usage().values() if requests)
+    if len(provider.calls) != args.requests or sum(requests for requests, _ in pool.usage().values()) != args.requests:
+        failures.append("not every request went through the pool exactly once")
+    if provider.created != routes_used or len(set(provider.created_for)) != routes_used:
+        failures.append(f"prefix registered {provider.created} times for {routes_used} keys in use, expected once per key")
+    if args.requests >= 2 * args.keys and routes_used != args.keys:
+        failures.append(f"only {routes_used} of {args.keys} keys were used")
+    if sum(sent) >= sum(inline):
+        failures.append(f"sent {sum(sent)} prompt tokens, not fewer than {sum(inline)} inline")
+
+    stats = cache.stats()
+    print(f"Static prefix: {estimate_tokens(static_prefix)} tokens (estimated); {args.requests} requests over {args.keys} keys")
+    print(f"Prompt tokens sent: {sum(sent)} with caching, {sum(inline)} inline "
+          f"({1 - sum(sent) / sum(inline):.0%} fewer)")
+    print(f"Prefix cache: {stats}; registered for {provider.created_for}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    print(f"Context cache check: {'OK' if not failures else f'{len(failures)} failures'}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,105 @@
+"""Cold-spawn vs warm-pool latency for terminal-mode commands.
+
+With --check, instead runs commands that could break or leak into a shared
+session (exit, set -e, exported variables, redefined builtins, cd) and
+checks that the pool gives the same results as a fresh process.
+
+Usage: python bench/bench_shell_pool.py [--shell auto|bash|pwsh|powershell] [--runs 50] [--command "echo hi"] [--check]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from shell_pool import ShellPool # noqa: E402
+from terminal_exec import TerminalExecutor # noqa: E402
+
+
+def summarize(name, samples):
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    print(f"{name:<10} runs={len(samples):<4} mean={statistics.mean(samples) * 1000:8.2f} ms  "
+          f"p50={statistics.median(samples) * 1000:8.2f} ms  p95={p95 * 1000:8.2f} ms")
+
+
+async def measure(executor, command, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        await executor.run(command, 'bench')
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+# bash: (first user's command, second user's command, expected (returncode, stdout) of the second)
+ISOLATION_CASES = [
+    ('echo out; exit 3', 'echo hi', (0, 'hi')),
+    ('set -e; false; echo unreachable', 'echo hi', (0, 'hi')),
+    ('export UNIUI_LEAK=secret', 'echo "[$UNIUI_LEAK]"', (0, '[]')),
+    ('printf() { :; }; echo() { :; }', 'echo hi', (0, 'hi')),
+    ('builtin() { :; }; trap "echo trapped" EXIT', 'echo hi', (0, 'hi')),
+    ('cd /', 'pwd', (0, os.getcwd())),
+]
+
+
+async def outcome(executor, command, user_id):
+    try:
+        result = await executor.run(command, user_id)
+    except Exception as e:
+        return type(e).__name__, str(e)
+    return result.returncode, result.stdout.strip()
+
+
+async def check_isolation(shell):
+    """Runs each case on one pooled session and compares it with a fresh process; returns failures."""
+    failures = 0
+    for user_affinity in (False, True):
+        pool = ShellPool(shell=shell, size=1, user_affinity=user_affinity)
+        executor = TerminalExecutor(shell=shell, pool=pool)
+        for first, second, expected in ISOLATION_CASES:
+            fresh = await outcome(TerminalExecutor(shell=shell), first, 'first')
+            pooled = await outcome(executor, first, 'first')
+            results = [(fresh, pooled), (expected, await outcome(executor, second, 'second'))]
+            for wanted, got in results:
+                if wanted != got:
+                    failures += 1
+                    print(f"FAIL (user_affinity={user_affinity}) {first!r} then {second!r}: expected {wanted}, got {got}")
+        # With affinity, a user's cd carries over to their next command
+        if user_affinity:
+            await outcome(executor, 'cd /tmp', 'first')
+            after = await outcome(executor, 'pwd', 'first')
+            if after != (0, '/tmp'):
+                failures += 1
+                print(f"FAIL (user_affinity=True) cd did not carry over: {after}")
+        await pool.close()
+    print(f"Isolation check: {'OK' if not failures else f'{failures} failures'}")
+    return failures
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--shell', default='auto')
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--command', default='echo hi')
+    parser.add_argument('--check', action='store_true', help="Check session isolation instead (bash)")
+    args = parser.parse_args()
+    if args.check:
+        return 1 if await check_isolation(args.shell) else 0
+
+    cold = TerminalExecutor(shell=args.shell)
+    pool = ShellPool(shell=args.shell, size=1)
+    warm = TerminalExecutor(shell=args.shell, pool=pool)
+    await warm.start() # Pool start-up is a one-time cost, not part of per-command latency
+
+    print(f"Shell: {cold.shell}  Command: {args.command!r}")
+    summarize('cold', await measure(cold, args.command, args.runs))
+    summarize('pooled', await measure(warm, args.command, args.runs))
+    await pool.close()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
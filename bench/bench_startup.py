@@ -0,0 +1,65 @@
+"""Cold start: time to import app.py in a fresh interpreter, and the slowest imports.
+
+Everything up to connecting to Discord happens at import, so this is the
+start-to-login time minus the network. The bot itself prints the full
+breakdown (imports, init, login, ready) once it is ready. Like the load
+test, the child imports app with its data paths in a temporary directory,
+so nothing is written under config/.
+
+Usage: python bench/bench_startup.py [--runs 5] [--top 10]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from load_test import write_config_overrides
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def import_app(overrides, extra_args=()):
+    env = dict(os.environ, DISCORD_BOT_TOKEN='', UNIUI_CONFIG_OVERRIDES=overrides)
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-W', 'ignore', *extra_args, '-c', 'import app'],
+                            cwd=ROOT, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - started
+    if result.returncode:
+        raise RuntimeError(f"import app failed:\n{result.stderr[-2000:]}")
+    return elapsed, result.stderr
+
+
+def slowest_imports(stderr, top):
+    """Modules imported directly by app.py, by cumulative import time (``-X importtime`` output)."""
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2 # Two spaces per nesting level
+        if depth == 1:
+            packages[name.strip()] = int(cumulative)
+    ranked = sorted(packages.items(), key=lambda item: -item[1])[:top]
+    return [(name, microseconds / 1e6) for name, microseconds in ranked]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(prefix='uniui-startup-') as directory:
+        overrides = write_config_overrides(os.path.join(directory, 'app'))
+        times = [import_app(overrides)[0] for _ in range(args.runs)]
+        _, stderr = import_app(overrides, ('-X', 'importtime'))
+    print(f"import app: median {statistics.median(times):.3f}s, min {min(times):.3f}s over {args.runs} runs")
+    print("Slowest imports from app.py (cumulative):")
+    for name, seconds in slowest_imports(stderr, args.top):
+        print(f"  {seconds:7.3f}s  {name}")
+
+
+if __name__ == '__main__':
+    main()
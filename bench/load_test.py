@@ -0,0 +1,372 @@
+"""Offline load test: drives the /uniui handler with fake Discord interactions and a fake Gemini.
+
+No Discord token or Gemini key is needed. The fake model sleeps for a
+log-normal first-token latency plus generation time at a fixed token rate
+(on the real AsyncGemini/GeminiPool threads), and can fail a fraction of
+calls with 429s. Memory, the retrieval index, logs and shared state go to
+a temporary directory (app.py is imported with UNIUI_CONFIG_OVERRIDES
+pointing there, so nothing is written under config/); the scheduler,
+caches, prompt assembly and terminal executor are the real ones.
+
+Usage:
+  python bench/load_test.py [--users 50] [--requests-per-user 4] [--think-time 0.5]
+                            [--latency 0.8] [--latency-sigma 0.5] [--tokens-per-second 150]
+                            [--reply-tokens 200] [--error-rate 0.05] [--keys 2] [--stream]
+                            [--max-active N] [--corpus config/logs] [--no-cache] [--tracemalloc]
+
+Reports throughput, end-to-end latency, per-stage latency, event-loop lag
+and memory growth.
+"""
+import argparse
+import asyncio
+import contextlib
+import glob
+import gzip
+import io
+import itertools
+import json
+import math
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) # app reads config/ relative paths
+
+import google.api_core.exceptions as api_exceptions # noqa: E402
+
+SYNTHETIC_MESSAGES = [
+    "What's a good name for a pet {animal}?",
+    "Explain {topic} like I'm five.",
+    "Write a short poem about {animal}s and {topic}.",
+    "Give me three tips for learning {topic}.",
+    "Summarize the history of {topic} in two sentences.",
+    "Why do {animal}s behave the way they do?",
+]
+ANIMALS = ['cat', 'dog', 'owl', 'otter', 'gecko', 'parrot', 'rabbit']
+TOPICS = ['recursion', 'photosynthesis', 'jazz', 'compound interest', 'black holes', 'sourdough', 'chess openings']
+
+
+# --- Fake Gemini ---
+class FakeResponse:
+    def __init__(self, text, prompt_tokens, reply_tokens):
+        self.text = text
+        self.candidates = [text]
+        self.prompt_feedback = None
+        self.usage_metadata = type('Usage', (), {
+            'prompt_token_count': prompt_tokens, 'candidates_token_count': reply_tokens})()
+
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeLLM:
+    """Shared settings and counters for every fake model (one per key/model route)."""
+
+    def __init__(self, latency, latency_sigma, tokens_per_second, reply_tokens, error_rate, seed=1):
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.throttled = 0
+
+    def model_factory(self, key, model_name):
+        return FakeModel(self)
+
+
+class FakeModel:
+    """Blocking stand-in for ``GenerativeModel`` (runs on AsyncGemini's worker threads)."""
+
+    def __init__(self, llm):
+        self.llm = llm
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        llm = self.llm
+        llm.calls += 1
+        first_token = llm.random.lognormvariate(math.log(llm.latency), llm.latency_sigma)
+        if llm.random.random() < llm.error_rate:
+            llm.throttled += 1
+            time.sleep(min(first_token, 0.05))
+            raise api_exceptions.ResourceExhausted("Fake quota exceeded")
+        if 'IMPORTANT TASK: You MUST translate' in str(prompt):
+            words = ['echo', 'benchmark']
+            if 'JSON object' in str(prompt): # Plan mode (terminal_plan.py)
+                words = [json.dumps({'command': 'echo benchmark', 'refusal': None, 'purpose': 'Prints a word.',
+                                     'success_note': 'That is the output.', 'needs_explanation': False})]
+        else:
+            words = [llm.random.choice(ANIMALS + TOPICS) for _ in range(llm.reply_tokens)]
+        prompt_tokens = len(str(prompt)) // 4
+        if not stream:
+            time.sleep(first_token + len(words) / llm.tokens_per_second)
+            return FakeResponse(' '.join(words), prompt_tokens, len(words))
+        return self._stream(words, first_token)
+
+    def _stream(self, words, first_token):
+        time.sleep(first_token)
+        for start in range(0, len(words), 20):
+            piece = words[start:start + 20]
+            time.sleep(len(piece) / self.llm.tokens_per_second)
+            yield FakeChunk(' '.join(piece) + ' ')
+
+
+# --- Fake Discord ---
+class FakeMessage:
+    def __init__(self, client, content):
+        self.client = client
+        self.content = content
+
+    async def edit(self, content=None, **kwargs):
+        await asyncio.sleep(self.client.discord_latency)
+        self.content = content
+        self.client.edits += 1
+
+
+class FakeFollowup:
+    def __init__(self, client):
+        self.client = client
+
+    async def send(self, content=None, file=None, wait=False, **kwargs):
+        await asyncio.sleep(self.client.discord_latency)
+        if file is not None:
+            file.close()
+        self.client.sends += 1
+        if content and content.startswith("Error:"):
+            self.client.errors += 1
+        return FakeMessage(self.client, content)
+
+
+class FakeDiscord:
+    """Counts what the handler sends; every call takes ``discord_latency`` seconds."""
+
+    def __init__(self, discord_latency):
+        self.discord_latency = discord_latency
+        self.sends = 0
+        self.edits = 0
+        self.errors = 0
+
+
+class FakeInteractionResponse:
+    def __init__(self, client):
+        self.client = client
+
+    async def defer(self, thinking=False, **kwargs):
+        await asyncio.sleep(self.client.discord_latency)
+
+
+class FakeUser:
+    def __init__(self, user_id, display_name):
+        self.id = user_id
+        self.display_name = display_name
+
+
+class FakeInteraction:
+    """The parts of ``discord.Interaction`` that the handler uses."""
+
+    def __init__(self, client, user, guild_id):
+        self.user = user
+        self.guild_id = guild_id
+        self.guild = f"Bench Guild {guild_id}"
+        self.response = FakeInteractionResponse(client)
+        self.followup = FakeFollowup(client)
+        self.client = client
+
+    async def edit_original_response(self, content=None, **kwargs):
+        await asyncio.sleep(self.client.discord_latency)
+        self.client.edits += 1
+
+    async def delete_original_response(self):
+        await asyncio.sleep(self.client.discord_latency)
+
+
+# --- Workload ---
+def load_corpus(directory):
+    """User messages from interaction logs (``input`` events), oldest files first."""
+    messages = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.jsonl')) + glob.glob(os.path.join(directory, '*.jsonl.gz'))):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('event') == 'input' and record.get('message'):
+                    messages.append(record['message'])
+    return messages
+
+
+def synthetic_messages(count, seed):
+    rng = random.Random(seed)
+    return [rng.choice(SYNTHETIC_MESSAGES).format(animal=rng.choice(ANIMALS), topic=rng.choice(TOPICS))
+            for _ in range(count)]
+
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def rss_mb():
+    """Current resident set size (Linux), else peak RSS."""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+async def run(args, app, services_dir):
+    from gemini_pool import GeminiPool
+    from llm_client import AsyncGemini
+    from memory_index import MemoryIndex
+    from memory_store import MemoryStore, SQLiteMemoryBackend
+    from interaction_log import InteractionLogger
+    from response_cache import ResponseCache, create_response_cache
+    from context_cache import LocalStubProvider, PrefixCache
+    from scheduler import create_scheduler
+    from metrics import Metrics
+
+    llm = FakeLLM(args.latency, args.latency_sigma, args.tokens_per_second, args.reply_tokens, args.error_rate, args.seed)
+    pool = GeminiPool([f'bench-key-{i}' for i in range(args.keys)], ['fake-flash'], backoff_base=0.1, backoff_max=2.0,
+                      model_factory=llm.model_factory)
+    gemini = AsyncGemini(pool.primary_model, max_in_flight=args.max_in_flight * args.keys, pool=pool)
+    backend = SQLiteMemoryBackend(os.path.join(services_dir, 'memory.db'), legacy_directory=services_dir)
+    memory_store = MemoryStore(backend, window=app.memory_count)
+    scheduler = create_scheduler(app.config)
+    if args.max_active:
+        scheduler.max_active = args.max_active
+    metrics = Metrics(port=0, loop_lag_interval=0.01)
+    app.configure_services(
+        gemini_async=gemini,
+        gemini_pool=pool,
+        prefix_cache=PrefixCache(LocalStubProvider(), gemini.run, enabled=False),
+        memory_store=memory_store,
+        memory_index=MemoryIndex(os.path.join(services_dir, 'index'), history=backend.history),
+        interaction_logger=InteractionLogger(os.path.join(services_dir, 'logs')),
+        response_cache=ResponseCache(enabled=False) if args.no_cache else create_response_cache(app.config),
+        request_scheduler=scheduler,
+        metrics=metrics,
+    )
+    app.stream_responses = args.stream
+    discord_client = FakeDiscord(args.discord_latency)
+
+    corpus = load_corpus(args.corpus) if args.corpus else []
+    if args.corpus and not corpus:
+        print(f"No input events found under {args.corpus}; using synthetic messages.")
+    messages = itertools.cycle(corpus or synthetic_messages(1000, args.seed))
+    think = random.Random(args.seed + 1)
+    latencies = []
+
+    async def user_session(index):
+        user = FakeUser(100000 + index, f"bench-user-{index}")
+        guild_id = 1000 + index % args.guilds
+        for _ in range(args.requests_per_user):
+            interaction = FakeInteraction(discord_client, user, guild_id)
+            started = time.perf_counter()
+            await app.handle_interaction(interaction, next(messages))
+            latencies.append(time.perf_counter() - started)
+            if args.think_time:
+                await asyncio.sleep(think.expovariate(1 / args.think_time))
+
+    await metrics.start()
+    rss_before = rss_mb()
+    if args.tracemalloc:
+        tracemalloc.start()
+    started = time.perf_counter()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else output):
+        await asyncio.gather(*(user_session(i) for i in range(args.users)))
+        await memory_store.flush()
+    elapsed = time.perf_counter() - started
+    traced = tracemalloc.get_traced_memory() if args.tracemalloc else None
+    rss_after = rss_mb()
+
+    summary = metrics.summary()
+    lag = summary['histograms'].get('event_loop_lag_seconds', {})
+    print(f"Requests: {len(latencies)} from {args.users} users in {elapsed:.2f}s "
+          f"-> {len(latencies) / elapsed:.1f} req/s")
+    print(f"End-to-end latency: p50={percentile(latencies, 0.50):.3f}s p95={percentile(latencies, 0.95):.3f}s "
+          f"p99={percentile(latencies, 0.99):.3f}s max={max(latencies, default=0):.3f}s")
+    print(f"Event loop lag: p50={lag.get('p50', 0) * 1000:.1f}ms p99={lag.get('p99', 0) * 1000:.1f}ms "
+          f"max={lag.get('max', 0) * 1000:.1f}ms")
+    print(f"Fake LLM: {llm.calls} calls, {llm.throttled} injected 429s; pool retries={pool.retries}")
+    print(f"Scheduler: {scheduler.stats()}")
+    print(f"Discord: {discord_client.sends} sends, {discord_client.edits} edits, {discord_client.errors} error replies")
+    print(f"Memory: RSS {rss_before:.1f} MB -> {rss_after:.1f} MB ({rss_after - rss_before:+.1f} MB)"
+          + (f", traced current={traced[0] / 1e6:.1f} MB peak={traced[1] / 1e6:.1f} MB" if traced else ""))
+    print("Stages:")
+    for name, stats in summary['histograms'].items():
+        if name.startswith('stage_seconds'):
+            print(f"  {name[len('stage_seconds['):-1]:<14} n={stats['count']:<6} p50={stats['p50']:.3f}s "
+                  f"p95={stats['p95']:.3f}s p99={stats['p99']:.3f}s")
+
+    gemini.shutdown()
+    memory_store.close()
+    app.memory_index.close()
+    app.interaction_logger.close()
+
+
+def write_config_overrides(directory):
+    """Writes an .ini that moves every path app.py writes to under ``directory``; returns its path."""
+    os.makedirs(directory)
+    path = os.path.join(directory, 'overrides.ini')
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(
+            f"[LIMIT]\ndatabase = {os.path.join(directory, 'memory.db')}\n"
+            f"index_directory = {os.path.join(directory, 'index')}\n"
+            f"[LOGGING]\ndirectory = {os.path.join(directory, 'logs')}\n"
+            f"[SHARDING]\nshared_state = {os.path.join(directory, 'shared.db')}\n"
+            f"[COMMAND_SYNC]\nstate_file = {os.path.join(directory, 'command_sync.json')}\n")
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--requests-per-user', type=int, default=4)
+    parser.add_argument('--think-time', type=float, default=0.5, help="Mean seconds between a user's requests")
+    parser.add_argument('--guilds', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.8, help="Median first-token latency in seconds")
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help="Log-normal sigma of the latency")
+    parser.add_argument('--tokens-per-second', type=float, default=150.0)
+    parser.add_argument('--reply-tokens', type=int, default=200)
+    parser.add_argument('--error-rate', type=float, default=0.05, help="Fraction of LLM calls failing with 429")
+    parser.add_argument('--keys', type=int, default=2, help="Fake API keys in the pool")
+    parser.add_argument('--max-in-flight', type=int, default=4, help="Concurrent LLM calls per key")
+    parser.add_argument('--max-active', type=int, default=0, help="Override [SCHEDULER] max_active")
+    parser.add_argument('--discord-latency', type=float, default=0.05)
+    parser.add_argument('--stream', action='store_true', help="Use streaming replies")
+    parser.add_argument('--no-cache', action='store_true', help="Disable the response cache")
+    parser.add_argument('--corpus', help="Replay user messages from interaction logs in this directory")
+    parser.add_argument('--tracemalloc', action='store_true', help="Also trace Python allocations (slower)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true', help="Show the bot's own output")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='uniui-bench-') as services_dir:
+        # app builds its stores and log writer at import; keep them out of config/
+        os.environ['UNIUI_CONFIG_OVERRIDES'] = write_config_overrides(os.path.join(services_dir, 'app'))
+        with contextlib.redirect_stdout(io.StringIO()):
+            import app
+        imported = [app.interaction_logger, app.memory_store, app.memory_index] # Replaced by run()'s own
+        try:
+            asyncio.run(run(args, app, services_dir))
+        finally:
+            for service in imported:
+                if service is not None:
+                    service.close()
+
+
+if __name__ == '__main__':
+    main()
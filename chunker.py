@@ -0,0 +1,149 @@
+"""Splitting replies into Discord-sized messages, with an attachment fallback.
+
+``iter_discord_chunks`` walks the text once, line by line, and yields each
+chunk as soon as it is full, so cost is linear in the text size. Code
+fences are tracked across chunk boundaries (a ``````` anywhere in a line
+opens or closes a block, as in Discord): a chunk that ends inside a code
+block is closed with ``````` and the next one reopens it with the same
+fence (language hint included). Lines longer than a whole message are cut.
+
+Very long replies (a multi-megabyte directory listing, say) would take
+hundreds of followups and run into Discord's rate limits. Past
+``max_chunks`` messages or ``max_chars`` characters, ``plan_reply`` sends a
+short preview plus the full text as one (optionally gzip-compressed) file.
+"""
+import gzip
+import itertools
+import re
+
+FENCE = '```'
+CLOSE = '\n```'
+MAX_FENCE_LENGTH = 100 # Longer "opening fences" are treated as plain ```
+_BACKTICK_RUN = re.compile(r'`(?=``)')
+ZERO_WIDTH_SPACE = '\u200b'
+
+
+def code_block(text, language=''):
+    """``text`` in a fenced code block; backtick runs inside are broken with zero-width spaces so they can't end it."""
+    return f"{FENCE}{language}\n{_BACKTICK_RUN.sub('`' + ZERO_WIDTH_SPACE, text)}\n{FENCE}"
+
+
+def _fence_after(line, fence):
+    """The open fence after ``line``, given the one open before it (None outside a code block).
+
+    Discord ends a block at the next ``` anywhere in a line, and a block
+    opened mid-line runs on to the following lines.
+    """
+    index = line.find(FENCE)
+    while index != -1:
+        if fence is None:
+            opening = line[index:].strip()
+            fence = opening if len(opening) <= MAX_FENCE_LENGTH else FENCE
+        else:
+            fence = None
+        index = line.find(FENCE, index + len(FENCE))
+    return fence
+
+
+def iter_discord_chunks(text, limit=1990):
+    """Yields chunks of at most ``limit`` characters with balanced code fences."""
+    current = [] # Lines of the chunk being built
+    length = 0 # len('\n'.join(current))
+    fence = None # Opening fence while inside a code block
+    fresh = True # Current chunk holds nothing but a reopened fence
+
+    def finish():
+        chunk = '\n'.join(current).strip('\n')
+        if fence is not None:
+            chunk += CLOSE
+        return chunk
+
+    def reopen():
+        return ([fence], len(fence)) if fence is not None else ([], 0)
+
+    for line in text.split('\n'):
+        while True:
+            after = _fence_after(line, fence)
+            # Room for a closing ``` is reserved whenever the line leaves a block open
+            reserve = len(CLOSE) if after is not None else 0
+            separator = 1 if current else 0
+            room = limit - reserve - length - separator
+            if len(line) <= room:
+                break
+            if not fresh:
+                chunk = finish()
+                if chunk.strip():
+                    yield chunk
+                current, length = reopen()
+                fresh = True
+                continue
+            # The line alone does not fit in a message: cut it
+            room = max(room, 1)
+            head, line = line[:room], line[room:]
+            current.append(head)
+            length += separator + len(head)
+            fence = _fence_after(head, fence)
+            yield finish()
+            current, length = reopen()
+
+        length += len(line) + (1 if current else 0)
+        current.append(line)
+        # A chunk holding only a reopened fence (or an opening fence line) is still fresh
+        fresh = fresh and (not line.strip() or (fence is None and after == line.strip()))
+        fence = after
+
+    if current:
+        chunk = finish()
+        if chunk.strip() and not (fence is not None and chunk == f'{fence}{CLOSE}'):
+            yield chunk
+
+
+def split_message(text, limit=1990):
+    """All chunks as a list."""
+    return list(iter_discord_chunks(text, limit))
+
+
+class ReplyPlan:
+    """How to deliver a reply: ``chunks`` to send as messages, or ``preview`` plus an attachment."""
+    __slots__ = ('chunks', 'preview', 'attachment', 'filename')
+
+    def __init__(self, chunks=None, preview=None, attachment=None, filename=None):
+        self.chunks = chunks
+        self.preview = preview
+        self.attachment = attachment
+        self.filename = filename
+
+    @property
+    def as_attachment(self):
+        return self.attachment is not None
+
+
+def plan_reply(text, limit=1990, max_chunks=5, max_chars=10000, compress=True, preview_chars=1500,
+               filename='reply.txt', max_attachment_bytes=8 * 1024 * 1024):
+    """Chunks for short replies; a preview and a (gzip) text file past either threshold.
+
+    Counting stops after ``max_chunks + 1`` chunks, so deciding is cheap even
+    for huge texts.
+    """
+    if len(text) <= max_chars:
+        chunks = list(itertools.islice(iter_discord_chunks(text, limit), max_chunks + 1))
+        if len(chunks) <= max_chunks:
+            return ReplyPlan(chunks=chunks)
+
+    data = text.encode('utf-8')
+    note = ''
+    if len(data) > max_attachment_bytes and not compress:
+        data = data[:max_attachment_bytes]
+        note = ', truncated'
+    if compress:
+        data = gzip.compress(data, compresslevel=6)
+        filename += '.gz'
+        if len(data) > max_attachment_bytes:
+            # Keep roughly the share of the text that fits once compressed
+            keep = int(len(text) * max_attachment_bytes / len(data) * 0.9)
+            data = gzip.compress(text[:keep].encode('utf-8'), compresslevel=6)
+            note = ', truncated'
+    line_count = text.count('\n') + (0 if text.endswith('\n') else 1)
+    summary = f"\n*Full output attached as `{filename}` ({line_count:,} lines, {len(text):,} characters{note}).*"
+    preview = next(iter_discord_chunks(text, max(1, min(preview_chars, limit - len(summary)))), '')
+    return ReplyPlan(preview=preview + summary, attachment=data, filename=filename)
@@ -0,0 +1,45 @@
+"""Slash-command sync only when the command definitions change.
+
+A global ``tree.sync()`` overwrites every command in one heavily rate-limited
+request, and Discord takes a while to roll it out, so syncing on every start
+is wasted work. ``sync_if_changed`` hashes the payload that would be sent
+(names, descriptions, parameters, as ``Command.to_dict`` renders them) with
+the application id, and syncs only if the hash differs from the one stored
+after the last successful sync.
+"""
+import hashlib
+import json
+import os
+
+
+def command_fingerprint(tree, application_id):
+    """SHA-256 of the tree's global command payload for this application."""
+    payload = sorted((command.to_dict(tree) for command in tree.get_commands()), key=lambda item: item['name'])
+    data = json.dumps({'application_id': application_id, 'commands': payload}, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def _read_state(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            return json.load(file).get('fingerprint')
+    except (OSError, ValueError):
+        return None
+
+
+def _write_state(path, fingerprint):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temporary = path + '.tmp'
+    with open(temporary, 'w', encoding='utf-8') as file:
+        json.dump({'fingerprint': fingerprint}, file)
+    os.replace(temporary, path)
+
+
+async def sync_if_changed(tree, application_id, state_path, force=False):
+    """Syncs global commands if they changed since the last sync; returns True if it synced."""
+    fingerprint = command_fingerprint(tree, application_id)
+    if not force and _read_state(state_path) == fingerprint:
+        return False
+    await tree.sync(guild=None)
+    _write_state(state_path, fingerprint)
+    return True
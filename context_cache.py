@@ -0,0 +1,252 @@
+"""Context caching for the static part of every prompt.
+
+The personality prompt from prompt.ini and the fixed trigger instructions
+are identical on every call. ``PrefixCache`` registers each distinct static
+prefix with the provider's context-caching API once per route (cached
+content belongs to the API key that created it), and hands back a model
+bound to that cached content, so only the per-request part of the prompt is
+sent as fresh input tokens. ``AsyncGemini`` asks for it after the pool has
+picked a route, so cached calls are spread, retried and rate-counted
+across keys like any other.
+
+Cache entries are refreshed before they expire and dropped (server side
+too) when prompt.ini changes. If caching is disabled, the prefix is too
+short for the provider, or the provider call fails, ``model_for`` returns
+None and callers send the full prompt inline as before.
+"""
+import abc
+import asyncio
+import datetime
+import hashlib
+import os
+import time
+
+from prompt_builder import estimate_tokens
+
+
+class ContextCacheProvider(abc.ABC):
+    """Interface for a context-caching backend. Methods are blocking."""
+
+    @abc.abstractmethod
+    def create(self, prefix, ttl, route=None):
+        """Registers ``prefix`` for ``route`` (a gemini_pool.Route, or None for the default key and model).
+
+        Returns (handle, model bound to the cached prefix).
+        """
+
+    @abc.abstractmethod
+    def delete(self, handle):
+        """Deletes a prefix registered by ``create``."""
+
+
+class GeminiContextCacheProvider(ContextCacheProvider):
+    """Gemini's CachedContent API; the prefix becomes the cached system instruction.
+
+    Each route's cache is created with that route's own API key through the
+    cache service client, and bound to a model using the same key.
+    """
+
+    def __init__(self, model_name, api_key=None, model_factory=None):
+        self.model_name = model_name
+        self.api_key = api_key
+        self.model_factory = model_factory # (api_key, model_name, cached_content) -> model; gemini_pool's by default
+
+    def create(self, prefix, ttl, route=None):
+        from google.ai import generativelanguage as glm
+        api_key = route.api_key if route is not None else self.api_key
+        model_name = route.model_name if route is not None else self.model_name
+        client = glm.CacheServiceClient(client_options={'api_key': api_key})
+        cached = client.create_cached_content(cached_content=glm.CachedContent(
+            model=model_name if model_name.startswith('models/') else f'models/{model_name}',
+            system_instruction=glm.Content(parts=[glm.Part(text=prefix)]),
+            ttl=datetime.timedelta(seconds=ttl),
+        ))
+        factory = self.model_factory
+        if factory is None:
+            from gemini_pool import make_gemini_model as factory
+        return (client, cached.name), factory(api_key, model_name, cached)
+
+    def delete(self, handle):
+        client, name = handle
+        client.delete_cached_content(name=name)
+
+
+class LocalStubProvider(ContextCacheProvider):
+    """Offline stand-in that records prefix registrations and calls.
+
+    ``created`` counts registrations (``created_for`` lists their route
+    labels) and ``calls`` lists (prefix, contents) for every generate call,
+    so tests and benchmarks can check that the prefix is reused and only the
+    dynamic part is sent.
+    """
+
+    class _Response:
+        def __init__(self, text):
+            self.text = text
+            self.candidates = [text]
+            self.prompt_feedback = None
+
+    class _Model:
+        def __init__(self, provider, prefix):
+            self.provider = provider
+            self.prefix = prefix
+
+        def generate_content(self, contents, **kwargs):
+            self.provider.calls.append((self.prefix, contents))
+            return LocalStubProvider._Response(self.provider.reply)
+
+    def __init__(self, reply="stub reply"):
+        self.reply = reply
+        self.created = 0
+        self.created_for = []
+        self.deleted = 0
+        self.calls = []
+
+    def create(self, prefix, ttl, route=None):
+        self.created += 1
+        self.created_for.append(route.label if route is not None else None)
+        return prefix, self._Model(self, prefix)
+
+    def delete(self, handle):
+        self.deleted += 1
+
+
+class _Entry:
+    __slots__ = ('handle', 'model', 'expires_at', 'tokens')
+
+    def __init__(self, handle, model, expires_at, tokens):
+        self.handle = handle
+        self.model = model
+        self.expires_at = expires_at
+        self.tokens = tokens
+
+
+class PrefixCache:
+    """Manages cached prefixes: creation, refresh, invalidation and inline fallback.
+
+    ``run_blocking(func, *args)`` runs provider calls off the event loop
+    (``AsyncGemini.run``). ``on_source_change`` is called when ``watch_path``
+    changes on disk, before existing entries are dropped.
+    """
+
+    def __init__(self, provider, run_blocking, ttl=3600, refresh_margin=300, min_tokens=1024,
+                 retry_after=600, watch_path=None, on_source_change=None, check_interval=5.0, enabled=True):
+        self.provider = provider
+        self.run_blocking = run_blocking
+        self.ttl = ttl
+        self.refresh_margin = min(refresh_margin, ttl / 2)
+        self.min_tokens = min_tokens
+        self.retry_after = retry_after
+        self.watch_path = watch_path
+        self.on_source_change = on_source_change
+        self.check_interval = check_interval
+        self.enabled = enabled
+        self._entries = {} # (prefix key, route label) -> _Entry
+        self._locks = {}
+        self._unavailable = {} # (prefix key, route label) -> time after which creation may be retried
+        self._source_mtime = self._mtime()
+        self._next_check = time.monotonic() + check_interval
+        self._background = set()
+        self.hits = 0
+        self.inline = 0
+        self.created = 0
+        self.tokens_saved = 0
+
+    def _mtime(self):
+        if not self.watch_path:
+            return None
+        try:
+            return os.stat(self.watch_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def check_source(self):
+        """Invalidates everything if the watched prompt file changed."""
+        if not self.watch_path or time.monotonic() < self._next_check:
+            return False
+        self._next_check = time.monotonic() + self.check_interval
+        mtime = self._mtime()
+        if mtime == self._source_mtime:
+            return False
+        self._source_mtime = mtime
+        print(f"{self.watch_path} changed; reloading and invalidating cached prompt prefixes.")
+        if self.on_source_change:
+            self.on_source_change()
+        self.invalidate()
+        return True
+
+    def invalidate(self, key=None, route=None):
+        """Drops a cached prefix (for one route, or all of them; or everything) and deletes it on the provider."""
+        label = route.label if route is not None else None
+        keys = [slot for slot in self._entries
+                if key is None or (slot[0] == key and (route is None or slot[1] == label))]
+        for dropped in keys:
+            entry = self._entries.pop(dropped, None)
+            if entry is not None:
+                self._delete_later(entry)
+
+    def _delete_later(self, entry):
+        async def delete():
+            try:
+                await self.run_blocking(self.provider.delete, entry.handle)
+            except Exception as e:
+                print(f"Error deleting cached prompt prefix: {e}")
+        try:
+            task = asyncio.ensure_future(delete())
+        except RuntimeError: # No running loop (e.g. during shutdown); the provider's TTL cleans up
+            return
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    @staticmethod
+    def key_for(prefix):
+        return hashlib.sha256(prefix.encode('utf-8')).hexdigest()
+
+    async def model_for(self, prefix, route=None):
+        """A model for ``route`` bound to the cached ``prefix``, or None to send the prompt inline."""
+        self.check_source()
+        if not self.enabled:
+            return None
+        tokens = estimate_tokens(prefix)
+        if tokens < self.min_tokens:
+            self.inline += 1
+            return None
+        key = (self.key_for(prefix), route.label if route is not None else None)
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and now < entry.expires_at - self.refresh_margin:
+            self.hits += 1
+            self.tokens_saved += entry.tokens
+            return entry.model
+        if self._unavailable.get(key, 0) > now:
+            self.inline += 1
+            return entry.model if entry is not None and now < entry.expires_at else None
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self._entries.get(key)
+            now = time.monotonic()
+            if entry is None or now >= entry.expires_at - self.refresh_margin:
+                try:
+                    handle, model = await self.run_blocking(self.provider.create, prefix, self.ttl, route)
+                except Exception as e:
+                    print(f"Context caching unavailable, sending prompts inline: {e}")
+                    self._unavailable[key] = now + self.retry_after
+                    self.inline += 1
+                    return entry.model if entry is not None and now < entry.expires_at else None
+                self.created += 1
+                if entry is not None:
+                    self._delete_later(entry) # Replaced by the refreshed cache
+                entry = self._entries[key] = _Entry(handle, model, now + self.ttl, tokens)
+        self.hits += 1
+        self.tokens_saved += entry.tokens
+        return entry.model
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'inline': self.inline,
+            'created': self.created,
+            'cached_prefixes': len(self._entries),
+            'estimated_tokens_saved': self.tokens_saved,
+        }
@@ -0,0 +1,254 @@
+"""Reply delivery: message packing, a cached thumbnail and fair send scheduling.
+
+``pack_reply`` turns the header and the reply text into as few followups as
+possible. With embeds, a message carries the header as its content plus up
+to 6000 characters of reply in embed descriptions (two 3000-character
+embeds), about three times what plain 2000-character messages hold. Without
+embeds, the header shares the first message when both fit.
+
+``ThumbnailCache`` reads config/thumbnail.png once (again only if the file
+changes). For embeds it remembers the CDN URL Discord returns for the first
+upload and reuses it until the signed URL is about to expire, so most
+replies send no image bytes at all.
+
+``SendScheduler`` runs sends for many replies concurrently while keeping
+each reply's messages in order. discord.py already waits out per-route
+rate limits; on top of that a token bucket keeps the bot under Discord's
+global request rate, and ready replies take turns, so one long reply
+cannot hold back the first message of everyone else's.
+"""
+import asyncio
+import collections
+import io
+import os
+import time
+import urllib.parse
+
+import discord
+
+from chunker import iter_discord_chunks
+
+MESSAGE_LIMIT = 2000
+EMBED_CHUNK = 3000 # Two per message stays within Discord's 6000-character embed total
+EMBEDS_PER_MESSAGE = 2
+
+
+class ThumbnailCache:
+    """Thumbnail bytes held in memory, plus the last uploaded CDN URL."""
+
+    def __init__(self, path='config/thumbnail.png', filename='thumbnail.png', url_margin=3600):
+        self.path = path
+        self.filename = filename
+        self.url_margin = url_margin
+        self._data = None
+        self._mtime = None
+        self._url = None
+        self._url_expires = 0.0
+        self.uploads = 0
+        self.reused = 0
+
+    def _load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            self._data = None
+            return None
+        if mtime != self._mtime:
+            with open(self.path, 'rb') as file:
+                self._data = file.read()
+            self._mtime = mtime
+            self._url = None # Changed image: upload it again
+        return self._data
+
+    @property
+    def available(self):
+        return self._load() is not None
+
+    def file(self):
+        """A fresh ``discord.File`` over the cached bytes (or None if there is no thumbnail)."""
+        data = self._load()
+        if data is None:
+            return None
+        self.uploads += 1
+        return discord.File(io.BytesIO(data), filename=self.filename)
+
+    def url(self):
+        """A previously uploaded URL that is still valid, else None."""
+        self._load()
+        if self._url and time.time() < self._url_expires - self.url_margin:
+            self.reused += 1
+            return self._url
+        return None
+
+    def remember(self, message):
+        """Keeps the CDN URL of the thumbnail a sent message carried."""
+        for embed in getattr(message, 'embeds', None) or ():
+            url = getattr(getattr(embed, 'thumbnail', None), 'url', None)
+            if url and not url.startswith('attachment://'):
+                self._set_url(url)
+                return
+        for attachment in getattr(message, 'attachments', None) or ():
+            if getattr(attachment, 'filename', None) == self.filename:
+                self._set_url(attachment.url)
+                return
+
+    def _set_url(self, url):
+        # Discord CDN links are signed; `ex` is the expiry as a hex Unix timestamp
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+        try:
+            expires = int(query['ex'][0], 16)
+        except (KeyError, ValueError):
+            expires = time.time() + 12 * 3600
+        self._url = url
+        self._url_expires = expires
+
+
+def _join(header, text):
+    return f"{header}\n{text}" if header else text
+
+
+def pack_reply(header, text, use_embeds=True, thumbnail=None, chunks=None):
+    """Message payloads (``followup.send`` keyword arguments) for a header and reply.
+
+    ``thumbnail`` is a ThumbnailCache to decorate the first message with, or
+    None. ``chunks`` are pre-split 2000-character chunks for plain mode.
+    """
+    payloads = []
+    if use_embeds:
+        embeds = [discord.Embed(description=chunk) for chunk in iter_discord_chunks(text, EMBED_CHUNK)]
+        for start in range(0, len(embeds), EMBEDS_PER_MESSAGE):
+            payloads.append({'embeds': embeds[start:start + EMBEDS_PER_MESSAGE]})
+        if not payloads:
+            payloads.append({})
+        if header:
+            payloads[0]['content'] = header
+        if thumbnail is not None and embeds and thumbnail.available:
+            url = thumbnail.url()
+            if url:
+                embeds[0].set_thumbnail(url=url)
+            else:
+                payloads[0]['file'] = thumbnail.file()
+                embeds[0].set_thumbnail(url=f'attachment://{thumbnail.filename}')
+        return payloads
+
+    chunks = list(chunks) if chunks is not None else list(iter_discord_chunks(text))
+    if header and chunks and len(header) + 1 + len(chunks[0]) <= MESSAGE_LIMIT:
+        chunks[0] = _join(header, chunks[0])
+    elif header:
+        chunks.insert(0, header)
+    payloads = [{'content': chunk} for chunk in chunks]
+    if thumbnail is not None and payloads:
+        # Image goes under the first chunk of the reply itself, as before
+        first_reply = 1 if header and payloads[0]['content'] == header and len(payloads) > 1 else 0
+        file = thumbnail.file()
+        if file is not None:
+            payloads[first_reply]['file'] = file
+    return payloads
+
+
+class SendScheduler:
+    """Fair, globally rate-limited dispatch of Discord sends.
+
+    Each ``route`` (one per interaction) sends strictly in order; different
+    routes run concurrently. Sends start at no more than ``rate`` per second
+    (bursts of ``burst``), taking turns between routes with work waiting.
+    """
+
+    def __init__(self, rate=45.0, burst=10):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self._queues = collections.OrderedDict() # route -> deque of (factory, future)
+        self._busy = set()
+        self._wakeup = None
+        self._worker = None
+        self._tasks = set()
+        self.sent = 0
+        self.throttled_seconds = 0.0
+
+    async def send(self, route, factory):
+        """Awaits ``factory()`` (a coroutine function) once it is this route's turn."""
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.ensure_future(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(route, collections.deque()).append((factory, future))
+        self._wakeup.set()
+        return await future
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def _next_route(self):
+        for route in self._queues:
+            if route not in self._busy:
+                return route
+        return None
+
+    async def _run(self):
+        try:
+            await self._schedule()
+        finally:
+            # The worker only stops when cancelled; fail whatever is still queued
+            for queue in self._queues.values():
+                for _, future in queue:
+                    future.cancel()
+            self._queues.clear()
+
+    async def _schedule(self):
+        while True:
+            route = self._next_route()
+            if route is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            self._refill()
+            if self._tokens < 1:
+                wait = (1 - self._tokens) / self.rate
+                self.throttled_seconds += wait
+                await asyncio.sleep(wait)
+                continue
+            self._tokens -= 1
+            queue = self._queues.pop(route)
+            factory, future = queue.popleft()
+            if queue:
+                self._queues[route] = queue # Back of the rotation
+            self._busy.add(route)
+            task = asyncio.ensure_future(self._dispatch(route, factory, future))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, route, factory, future):
+        try:
+            result = await factory()
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        except BaseException:
+            future.cancel() # Cancelled mid-send (e.g. shutdown): don't leave the caller waiting
+            raise
+        else:
+            self.sent += 1
+            if not future.done():
+                future.set_result(result)
+        finally:
+            self._busy.discard(route)
+            self._wakeup.set()
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'routes_waiting': len(self._queues),
+            'throttled_seconds': round(self.throttled_seconds, 2),
+        }
+
+
+def create_send_scheduler(config):
+    """Builds a SendScheduler from ai_config.ini [OUTPUT] (send_rate, send_burst)."""
+    return SendScheduler(
+        rate=config.getfloat('OUTPUT', 'send_rate', fallback=45.0),
+        burst=config.getint('OUTPUT', 'send_burst', fallback=10),
+    )
@@ -0,0 +1,390 @@
+"""Routing of Gemini calls across several API keys and models.
+
+A single key hits its quota long before the bot runs out of work. A
+``GeminiPool`` holds one route per (key, model) pair, tracks each route's
+requests and tokens over the last minute, and sends every call to the
+least-loaded healthy route of the first model that has one (the primary
+model first, fallbacks after it).
+
+A 429 puts the route on a growing cooldown and the call is retried on
+another route after a jittered backoff; 5xx errors do the same and count
+towards the route's circuit breaker. Authentication errors trip the
+breaker for every route of that key at once. An open breaker lets a single
+probe call through once its cooldown has passed and closes again if the
+probe succeeds.
+
+In a sharded deployment other processes use the same keys;
+``set_shared_usage`` adds their last-minute usage (see shared_state.py) to
+each route's own when checking quotas.
+
+Importing google-generativeai and google.api_core takes about a second, so
+neither is imported here until it is needed: models are built on first use
+(or by ``warm()`` in the background) and the exception classes are loaded
+the first time a call fails.
+"""
+import asyncio
+import collections
+import functools
+import random
+import threading
+import time
+
+WINDOW = 60.0 # Seconds over which request and token rates are measured
+SHARED_RECHECK = 1.0 # How long to wait when other processes have used up a route's quota
+
+
+@functools.cache
+def api_errors():
+    """``google.api_core.exceptions``, imported on first use."""
+    import google.api_core.exceptions as api_exceptions
+    return api_exceptions
+
+
+def throttled_errors():
+    return (api_errors().TooManyRequests,) # ResourceExhausted is a subclass
+
+
+def server_errors():
+    return (api_errors().ServerError,)
+
+
+def is_key_error(error):
+    """True for errors that mean the API key itself is unusable."""
+    api_exceptions = api_errors()
+    if isinstance(error, (api_exceptions.PermissionDenied, api_exceptions.Unauthenticated)):
+        return True
+    return isinstance(error, api_exceptions.InvalidArgument) and 'API key' in str(error)
+
+
+# google-generativeai has no public way to give a model its own API key, so
+# make_gemini_model swaps in a client from the private _ClientManager. Both
+# exist unchanged from 0.5 to 0.8 (the final release of the package).
+PER_KEY_CLIENT_VERSIONS = ((0, 5), (0, 9))
+
+
+def make_gemini_model(api_key, model_name, cached_content=None):
+    """A ``GenerativeModel`` bound to its own API key instead of the global one.
+
+    ``cached_content`` (created with the same key, see context_cache) makes
+    it a model that uses that cached prefix as its context.
+    """
+    from google import generativeai as genai
+    from google.generativeai import client
+
+    version = tuple(int(part) for part in genai.__version__.split('.')[:2] if part.isdigit())
+    low, high = PER_KEY_CLIENT_VERSIONS
+    if not low <= version < high or not hasattr(client, '_ClientManager'):
+        raise RuntimeError(
+            f"google-generativeai {genai.__version__} is not supported for per-key Gemini clients "
+            f"(tested with {low[0]}.{low[1]} to {high[0]}.{high[1] - 1}). "
+            "Install google-generativeai<0.9, or use a single key.")
+    manager = client._ClientManager()
+    manager.configure(api_key=api_key)
+    if cached_content is not None:
+        model = genai.GenerativeModel.from_cached_content(cached_content)
+    else:
+        model = genai.GenerativeModel(model_name)
+    if not hasattr(model, '_client'):
+        raise RuntimeError(f"google-generativeai {genai.__version__}: GenerativeModel has no _client to replace.")
+    model._client = manager.make_client("generative")
+    return model
+
+
+class Route:
+    """One (key, model) pair with its rate window and health state.
+
+    ``build`` makes the model when it is first needed. ``api_key`` is kept
+    for services that need their own per-key clients (context caching).
+    """
+
+    def __init__(self, key_index, model_name, build, rpm=0, tpm=0, api_key=None):
+        self.key_index = key_index
+        self.model_name = model_name
+        self.api_key = api_key
+        self._build = build
+        self._model = None
+        self._build_lock = threading.Lock() # warm() may build on another thread
+        self.rpm = rpm
+        self.tpm = tpm
+        self.in_flight = 0
+        self._requests = collections.deque() # timestamps
+        self._tokens = collections.deque() # (timestamp, tokens)
+        self._token_total = 0
+        self.shared_requests = 0 # Other processes' usage over the window
+        self.shared_tokens = 0
+        self.failures = 0 # Consecutive 5xx errors
+        self.throttled = 0 # Consecutive 429s
+        self.open_until = 0.0 # Circuit breaker; 0 when closed
+        self.open_for = 0.0
+        self.probing = False
+        self.cooldown_until = 0.0
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._build_lock:
+                if self._model is None:
+                    self._model = self._build()
+        return self._model
+
+    @property
+    def built(self):
+        return self._model is not None
+
+    @property
+    def label(self):
+        return f"{self.model_name}@key{self.key_index + 1}"
+
+    def _expire(self, now):
+        while self._requests and self._requests[0] <= now - WINDOW:
+            self._requests.popleft()
+        while self._tokens and self._tokens[0][0] <= now - WINDOW:
+            self._token_total -= self._tokens.popleft()[1]
+
+    def load(self, now):
+        """In-flight calls plus the fraction of the per-minute quotas already used."""
+        self._expire(now)
+        load = self.in_flight + (len(self._requests) + self.shared_requests) / (self.rpm or WINDOW)
+        if self.tpm:
+            load += (self._token_total + self.shared_tokens) / self.tpm
+        return load
+
+    def ready_at(self, now):
+        """When the route can take a call (``now`` if it can right away)."""
+        self._expire(now)
+        ready = max(now, self.cooldown_until)
+        if self.open_until:
+            ready = max(ready, self.open_until)
+        if self.rpm and len(self._requests) + self.shared_requests >= self.rpm:
+            ready = max(ready, self._requests[0] + WINDOW if len(self._requests) >= self.rpm else now + SHARED_RECHECK)
+        if self.tpm and self._token_total + self.shared_tokens >= self.tpm:
+            ready = max(ready, self._tokens[0][0] + WINDOW if self._token_total >= self.tpm else now + SHARED_RECHECK)
+        return ready
+
+    def available(self, now):
+        if self.open_until and self.probing:
+            return False # Half-open: one probe at a time
+        return self.ready_at(now) <= now
+
+    def begin(self, now, tokens):
+        """Counts a call against the route; returns True if it is the half-open probe."""
+        self.in_flight += 1
+        probe = bool(self.open_until)
+        if probe:
+            self.probing = True
+        self._requests.append(now)
+        self.add_tokens(now, tokens)
+        return probe
+
+    def add_tokens(self, now, tokens):
+        if tokens > 0:
+            self._tokens.append((now, tokens))
+            self._token_total += tokens
+
+    def stats(self, now):
+        self._expire(now)
+        if not self.open_until:
+            state = 'closed'
+        else:
+            state = 'half-open' if self.probing or now >= self.open_until else 'open'
+        return {
+            'route': self.label,
+            'in_flight': self.in_flight,
+            'requests_per_minute': len(self._requests),
+            'tokens_per_minute': self._token_total,
+            'other_processes_requests_per_minute': self.shared_requests,
+            'breaker': state,
+            'cooling_down': self.cooldown_until > now,
+        }
+
+
+class GeminiPool:
+    """Picks a route for each call and retries failed calls on other routes.
+
+    ``keys`` and ``model_names`` are tried in order of preference: every key
+    of the first model before any fallback model. ``rpm``/``tpm`` are each
+    route's per-minute quotas (0 if unknown); routes at their quota are
+    skipped until the window frees up.
+    """
+
+    def __init__(self, keys, model_names, rpm=0, tpm=0, max_attempts=4, backoff_base=0.5, backoff_max=8.0,
+                 failure_threshold=3, breaker_cooldown=30.0, key_error_cooldown=600.0, model_factory=make_gemini_model):
+        if not keys or not model_names:
+            raise ValueError("GeminiPool needs at least one API key and one model name")
+        self.key_count = len(keys)
+        self.tiers = [
+            [Route(index, name, functools.partial(model_factory, key, name), rpm, tpm, api_key=key)
+             for index, key in enumerate(keys)]
+            for name in model_names
+        ]
+        self.routes = [route for tier in self.tiers for route in tier]
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.key_error_cooldown = key_error_cooldown
+        self.retries = 0
+        self.failovers = 0 # Calls answered by a fallback model
+
+    @property
+    def primary_model(self):
+        return self.tiers[0][0].model
+
+    def warm(self):
+        """Builds every route's model now (blocking; run it off the event loop)."""
+        for route in self.routes:
+            route.model
+
+    def _pick(self, tried):
+        now = time.monotonic()
+        for tier in self.tiers:
+            candidates = [route for route in tier if route.available(now)]
+            untried = [route for route in candidates if route not in tried]
+            if candidates:
+                return min(untried or candidates, key=lambda route: route.load(now))
+        return None
+
+    def _wait_time(self):
+        now = time.monotonic()
+        return min(route.ready_at(now) for route in self.routes) - now
+
+    def _backoff(self, attempt):
+        """Full jitter: uniform in [0, min(max, base * 2**attempt)]."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _succeeded(self, route, result):
+        route.failures = 0
+        route.throttled = 0
+        route.open_until = 0.0
+        route.open_for = 0.0
+        route.probing = False
+        usage = getattr(result, 'usage_metadata', None)
+        completion = getattr(usage, 'candidates_token_count', 0) or 0
+        route.add_tokens(time.monotonic(), completion if isinstance(completion, int) else 0)
+
+    def _trip(self, route, cooldown):
+        route.open_for = cooldown if not route.open_for else min(route.open_for * 2, self.key_error_cooldown)
+        route.open_until = time.monotonic() + route.open_for
+        route.probing = False
+        print(f"Circuit breaker open for Gemini route {route.label} ({route.open_for:.0f}s).")
+
+    def _failed(self, route, error, probe):
+        now = time.monotonic()
+        if probe:
+            route.probing = False
+        elif route.open_until:
+            return # Started before the breaker opened; already accounted for
+        if is_key_error(error):
+            print(f"Gemini key {route.key_index + 1} was rejected: {error}")
+            for other in self.routes:
+                if other.key_index == route.key_index:
+                    self._trip(other, self.key_error_cooldown)
+        elif isinstance(error, throttled_errors()):
+            route.throttled += 1
+            route.cooldown_until = now + min(self.backoff_max * 4, self.backoff_base * (2 ** route.throttled))
+            if route.open_until: # A throttled probe keeps the breaker open
+                self._trip(route, self.breaker_cooldown)
+        else:
+            route.failures += 1
+            if route.open_until or route.failures >= self.failure_threshold:
+                self._trip(route, self.breaker_cooldown)
+
+    @staticmethod
+    def retryable(error):
+        return isinstance(error, throttled_errors() + server_errors()) or is_key_error(error)
+
+    async def call(self, attempt, tokens=0):
+        """Awaits ``attempt(model, route)`` on the best route, retrying on other routes.
+
+        ``tokens`` is the estimated prompt size, counted against the route's
+        token rate. Errors that are not about quota, server health or the key
+        are raised straight away; after ``max_attempts`` the last error is.
+        """
+        tried = set()
+        last_error = None
+        for number in range(self.max_attempts):
+            route = self._pick(tried)
+            if route is None:
+                wait = self._wait_time()
+                if wait > self.backoff_max or number == self.max_attempts - 1:
+                    break
+                await asyncio.sleep(wait + self._backoff(0))
+                route = self._pick(tried)
+                if route is None:
+                    continue
+            if number:
+                self.retries += 1
+            tried.add(route)
+            probe = route.begin(time.monotonic(), tokens)
+            try:
+                model = route.model if route.built else await asyncio.to_thread(lambda: route.model)
+                result = await attempt(model, route)
+            except Exception as e:
+                if not self.retryable(e):
+                    raise
+                self._failed(route, e, probe)
+                last_error = e
+                print(f"Gemini route {route.label} failed ({type(e).__name__}); retrying on another route.")
+            else:
+                if probe or not route.open_until:
+                    self._succeeded(route, result)
+                if route.model_name != self.tiers[0][0].model_name:
+                    self.failovers += 1
+                return result
+            finally:
+                # Also runs on cancellation, so the route is never left loaded or stuck half-open
+                route.in_flight -= 1
+                if probe:
+                    route.probing = False
+            if number < self.max_attempts - 1:
+                await asyncio.sleep(self._backoff(number))
+        if last_error is not None:
+            raise last_error
+        raise api_errors().ResourceExhausted("Every Gemini key is cooling down, over quota or unavailable.")
+
+    def usage(self):
+        """This process's ``{route label: (requests, tokens)}`` over the last minute."""
+        now = time.monotonic()
+        usage = {}
+        for route in self.routes:
+            route._expire(now)
+            usage[route.label] = (len(route._requests), route._token_total)
+        return usage
+
+    def set_shared_usage(self, totals):
+        """Other processes' usage per route label, as returned by ``SharedState.exchange_usage``."""
+        for route in self.routes:
+            route.shared_requests, route.shared_tokens = totals.get(route.label, (0, 0))
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            'retries': self.retries,
+            'failovers': self.failovers,
+            'routes': [route.stats(now) for route in self.routes],
+        }
+
+
+def _split_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def create_gemini_pool(config):
+    """Builds the pool from config/gemini.ini ([google] keys/models) and [GEMINI_POOL]."""
+    keys = _split_list(config.get('google', 'keys', fallback='')) or [config['google']['key']]
+    model_names = _split_list(config.get('google', 'models', fallback='')) or \
+        [config['google'].get('model', 'gemini-1.5-flash')]
+    section = 'GEMINI_POOL'
+    return GeminiPool(
+        keys,
+        model_names,
+        rpm=config.getint(section, 'rpm', fallback=0),
+        tpm=config.getint(section, 'tpm', fallback=0),
+        max_attempts=config.getint(section, 'max_attempts', fallback=4),
+        backoff_base=config.getfloat(section, 'backoff_base', fallback=0.5),
+        backoff_max=config.getfloat(section, 'backoff_max', fallback=8.0),
+        failure_threshold=config.getint(section, 'failure_threshold', fallback=3),
+        breaker_cooldown=config.getfloat(section, 'breaker_cooldown', fallback=30.0),
+        key_error_cooldown=config.getfloat(section, 'key_error_cooldown', fallback=600.0),
+    )
@@ -0,0 +1,122 @@
+"""Background interaction logger.
+
+Handlers call ``InteractionLogger.log(...)``, which only puts a record on a
+queue. A single writer thread batches records and appends them as JSON lines
+to ``<directory>/<YYYY-MM-DD>.jsonl``, flushing when a batch fills up or the
+flush interval passes. When the day changes the previous file is closed and,
+optionally, gzip-compressed. ``close()`` drains the queue on shutdown.
+Processes of a sharded deployment each write their own file
+(``<YYYY-MM-DD><suffix>.jsonl``).
+"""
+import datetime
+import gzip
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+
+
+class InteractionLogger:
+    """Queue-fed JSON-lines logger with one writer thread and daily rotation."""
+
+    _STOP = object()
+
+    def __init__(self, directory='config/logs', batch_size=200, flush_interval=2.0, compress=True, max_queue=100000,
+                 suffix=''):
+        self.directory = directory
+        self.suffix = suffix
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.compress = compress
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._file = None
+        self._file_date = None
+        os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="interaction-log", daemon=True)
+        self._thread.start()
+
+    def log(self, event, **fields):
+        """Queues one record; never blocks the caller."""
+        record = {'time': datetime.datetime.now().isoformat(), 'event': event}
+        record.update(fields)
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Flushes everything queued so far and stops the writer thread."""
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join()
+
+    # --- Writer thread ---
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = None
+            stopping = item is self._STOP
+            if item is not None and not stopping:
+                batch.append(item)
+            if stopping or len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                if batch:
+                    self._write(batch)
+                    batch = []
+                deadline = time.monotonic() + self.flush_interval
+            if stopping:
+                if self._file:
+                    self._file.close()
+                    self._file = None
+                return
+
+    def _write(self, batch):
+        try:
+            for record in batch:
+                self._rotate(record['time'][:10])
+                self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._file.flush()
+        except Exception as e:
+            print(f"Error writing interaction log batch ({len(batch)} records): {e}")
+
+    def _rotate(self, date):
+        if date == self._file_date:
+            return
+        if self._file:
+            previous = self._file.name
+            self._file.close()
+            if self.compress:
+                self._compress(previous)
+        elif self.compress:
+            # First write since startup: compress days left over from a previous run
+            for name in os.listdir(self.directory):
+                if name.endswith(f'{self.suffix}.jsonl') and name[:10] < date:
+                    self._compress(os.path.join(self.directory, name))
+        self._file = open(os.path.join(self.directory, f'{date}{self.suffix}.jsonl'), 'a', encoding='utf-8')
+        self._file_date = date
+
+    @staticmethod
+    def _compress(path):
+        try:
+            with open(path, 'rb') as source, gzip.open(path + '.gz', 'ab') as target:
+                shutil.copyfileobj(source, target)
+            os.remove(path)
+        except Exception as e:
+            print(f"Error compressing log file {path}: {e}")
+
+
+def create_interaction_logger(config, suffix=''):
+    """Builds the logger configured in config/logging.ini ([LOGGING])."""
+    return InteractionLogger(
+        directory=config.get('LOGGING', 'directory', fallback='config/logs'),
+        batch_size=config.getint('LOGGING', 'batch_size', fallback=200),
+        flush_interval=config.getfloat('LOGGING', 'flush_interval', fallback=2.0),
+        compress=config.getboolean('LOGGING', 'compress', fallback=True),
+        suffix=suffix,
+    )
@@ -0,0 +1,163 @@
+"""Runs the bot as several processes, each holding a group of Discord shards.
+
+One process handles every guild on one event loop and one CPU core. With
+``[SHARDING] enabled = true`` in config/sharding.ini, this launcher splits
+the shards into ``processes`` contiguous groups and starts ``app.py`` once
+per group. Each child gets its group in the environment (UNIUI_SHARD_IDS,
+UNIUI_SHARD_COUNT, UNIUI_PROCESS_INDEX, UNIUI_PROCESS_COUNT). Processes
+start one after the other, so their shards identify at the rate Discord
+allows. A process that exits with an error is restarted after a growing
+delay. Ctrl+C stops them all.
+
+Usage: python launcher.py [--processes N] [--shards N]
+"""
+import argparse
+import configparser
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+from dotenv import load_dotenv
+
+IDENTIFY_INTERVAL = 5.0 # Discord allows max_concurrency identifies per 5 seconds
+RESTART_DELAY_MAX = 60.0
+STOP_TIMEOUT = 15.0
+
+
+def read_config():
+    load_dotenv()
+    config = configparser.ConfigParser()
+    config.read('config/sharding.ini', encoding='utf-8')
+    token = config.get('discord', 'token', fallback=os.getenv("DISCORD_BOT_TOKEN"))
+    return config, token
+
+
+def gateway_info(token):
+    """Recommended shard count and identify concurrency from GET /gateway/bot."""
+    request = urllib.request.Request(
+        'https://discord.com/api/v10/gateway/bot',
+        headers={'Authorization': f'Bot {token}', 'User-Agent': 'DiscordBot (UniUI launcher, 1.0)'})
+    with urllib.request.urlopen(request, timeout=15) as response:
+        data = json.load(response)
+    return data['shards'], data.get('session_start_limit', {}).get('max_concurrency', 1)
+
+
+def shard_groups(shard_count, processes):
+    """Contiguous shard id ranges, one per process, as even as possible."""
+    processes = max(1, min(processes, shard_count))
+    return [list(range(shard_count * index // processes, shard_count * (index + 1) // processes))
+            for index in range(processes)]
+
+
+class Child:
+    """One app.py process and its restart bookkeeping."""
+
+    def __init__(self, index, shard_ids, env):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.env = env
+        self.process = None
+        self.started_at = 0.0
+        self.restart_delay = 1.0
+        self.restart_at = None
+        self.finished = False
+
+    def start(self):
+        self.process = subprocess.Popen([sys.executable, 'app.py'], env=self.env)
+        self.started_at = time.monotonic()
+        self.restart_at = None
+        print(f"Started process {self.index + 1} (pid {self.process.pid}) for shards {self.shard_ids}.")
+
+    def stop(self):
+        if self.process is None or self.process.poll() is not None:
+            return
+        if os.name == 'posix':
+            self.process.send_signal(signal.SIGINT) # The bot's shutdown path flushes memory and logs
+        else:
+            self.process.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, help="Overrides [SHARDING] processes")
+    parser.add_argument('--shards', type=int, help="Overrides [SHARDING] shard_count (0 = Discord's recommendation)")
+    args = parser.parse_args()
+    config, token = read_config()
+    if not config.getboolean('SHARDING', 'enabled', fallback=False):
+        print("ERROR: Set enabled = true in config/sharding.ini to run sharded.")
+        return 1
+    if not token:
+        print("ERROR: Discord token not found. Set DISCORD_BOT_TOKEN in .env or add config/token.ini")
+        return 1
+
+    shard_count = args.shards if args.shards is not None else config.getint('SHARDING', 'shard_count', fallback=0)
+    processes = args.processes or config.getint('SHARDING', 'processes', fallback=1)
+    max_concurrency = 1
+    try:
+        recommended, max_concurrency = gateway_info(token)
+        shard_count = shard_count or recommended
+    except Exception as e:
+        if not shard_count:
+            print(f"ERROR: Could not get the recommended shard count from Discord ({e}); set shard_count.")
+            return 1
+        print(f"Could not read gateway limits from Discord ({e}); identifying one shard at a time.")
+
+    groups = shard_groups(shard_count, processes)
+    print(f"Running {shard_count} shards in {len(groups)} processes.")
+    children = []
+    for index, shard_ids in enumerate(groups):
+        env = dict(os.environ,
+                   UNIUI_SHARD_IDS=','.join(map(str, shard_ids)),
+                   UNIUI_SHARD_COUNT=str(shard_count),
+                   UNIUI_PROCESS_INDEX=str(index),
+                   UNIUI_PROCESS_COUNT=str(len(groups)))
+        children.append(Child(index, shard_ids, env))
+
+    try:
+        for child in children:
+            child.start()
+            if child is not children[-1]:
+                # Let this group identify before the next one starts
+                time.sleep(IDENTIFY_INTERVAL * -(-len(child.shard_ids) // max_concurrency))
+        while True:
+            time.sleep(1.0)
+            now = time.monotonic()
+            for child in children:
+                code = child.process.poll()
+                if code is None or child.finished:
+                    continue
+                if code == 0:
+                    child.finished = True # Stopped on purpose (or could not log in)
+                    print(f"Process {child.index + 1} exited.")
+                elif child.restart_at is None:
+                    if now - child.started_at > RESTART_DELAY_MAX:
+                        child.restart_delay = 1.0 # Ran fine for a while; restart quickly
+                    child.restart_at = now + child.restart_delay
+                    print(f"Process {child.index + 1} exited with code {code}; restarting in {child.restart_delay:.0f}s.")
+                    child.restart_delay = min(child.restart_delay * 2, RESTART_DELAY_MAX)
+                elif now >= child.restart_at:
+                    child.start()
+            if all(child.finished for child in children):
+                break
+    except KeyboardInterrupt:
+        print("Stopping bot processes...")
+    finally:
+        for child in children:
+            child.stop()
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for child in children:
+            if child.process is None:
+                continue
+            try:
+                child.process.wait(timeout=max(0.1, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                child.process.kill()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,183 @@
+"""Async execution layer for Gemini calls.
+
+The google-generativeai client is synchronous, so calling it straight from a
+slash-command coroutine freezes the whole discord.py event loop (heartbeats,
+other users' interactions, followups). Everything here pushes the blocking
+call onto a bounded thread pool and awaits it, with a semaphore capping how
+many requests are in flight at once.
+
+With a ``GeminiPool`` (see gemini_pool) each call is routed to one of several
+API keys/models and retried on another after quota or server errors. A
+static ``prefix`` served from a ``PrefixCache`` (see context_cache) is
+registered per route, so cached-prefix calls are routed and retried the
+same way; if a route has no cached prefix, or it has expired, that attempt
+sends the whole prompt inline.
+"""
+import asyncio
+import concurrent.futures
+import functools
+
+from gemini_pool import api_errors
+from prompt_builder import estimate_tokens
+
+
+class ResponseBlocked(Exception):
+    """Raised when a streamed response produced no text (safety block or empty)."""
+
+    def __init__(self, reason):
+        super().__init__(f"Response blocked or empty (Reason: {reason})")
+        self.reason = reason
+
+
+def _estimate_tokens(prompt):
+    return estimate_tokens(prompt) if isinstance(prompt, str) else 0
+
+
+class AsyncGemini:
+    """Awaitable wrapper around a blocking ``GenerativeModel``.
+
+    ``max_in_flight`` bounds both the worker threads and the number of calls
+    that may be waiting on the API at the same time; extra callers queue on
+    the semaphore without blocking the loop.
+    """
+
+    def __init__(self, model=None, max_in_flight=4, pool=None):
+        self._model = model
+        self.pool = pool
+        self.max_in_flight = max(1, int(max_in_flight))
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_in_flight, thread_name_prefix="gemini"
+        )
+        self._semaphore = None  # Created on first use so it binds to the running loop
+        self.in_flight = 0
+
+    @property
+    def model(self):
+        """The default model: the one given, else the pool's primary model (built on first use)."""
+        return self._model if self._model is not None else self.pool.primary_model
+
+    def _get_semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        return self._semaphore
+
+    async def run(self, func, *args, **kwargs):
+        """Runs any blocking callable on the LLM pool under the in-flight limit."""
+        async with self._get_semaphore():
+            self.in_flight += 1
+            try:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+            finally:
+                self.in_flight -= 1
+
+    async def _bind(self, routed_model, route, prompt, prefix, prefix_cache):
+        """(model, prompt) for one attempt: the route's cached-prefix model and ``prompt``, or the full prompt inline."""
+        if prefix is None:
+            return routed_model, prompt
+        if prefix_cache is not None:
+            cached_model = await prefix_cache.model_for(prefix, route)
+            if cached_model is not None:
+                return cached_model, prompt
+        return routed_model, f"{prefix}\n{prompt}"
+
+    async def _call(self, attempt, tokens):
+        if self.pool is None:
+            return await attempt(self.model, None)
+        return await self.pool.call(attempt, tokens)
+
+    async def generate_content(self, prompt, prefix=None, prefix_cache=None, **kwargs):
+        """Awaitable equivalent of ``GenerativeModel.generate_content``.
+
+        With ``prefix``, the model sees ``prefix`` then ``prompt``; the prefix
+        comes from ``prefix_cache`` when the chosen route has it cached.
+        """
+        async def attempt(routed_model, route):
+            model, text = await self._bind(routed_model, route, prompt, prefix, prefix_cache)
+            try:
+                return await self.run(model.generate_content, text, **kwargs)
+            except api_errors().NotFound:
+                if model is routed_model:
+                    raise
+                # Cached content expired or was deleted server-side; drop it and resend inline on this route
+                prefix_cache.invalidate(prefix_cache.key_for(prefix), route)
+                return await self.run(routed_model.generate_content, f"{prefix}\n{prompt}", **kwargs)
+
+        return await self._call(attempt, _estimate_tokens(prompt if prefix is None else f"{prefix}\n{prompt}"))
+
+    async def stream_content(self, prompt, prefix=None, prefix_cache=None, **kwargs):
+        """Async generator yielding text pieces from a streamed ``generate_content``.
+
+        The blocking stream is iterated on a worker thread and handed back to
+        the loop through a queue, so the slot is held for the whole stream but
+        the loop is free between chunks. With a pool, a stream that fails
+        before its first piece is retried on another route. ``prefix`` and
+        ``prefix_cache`` work as in ``generate_content``.
+        """
+        stream = None
+
+        async def first_piece(model, text):
+            nonlocal stream
+            stream = self._stream(model, text, **kwargs)
+            try:
+                return await stream.__anext__()
+            except BaseException:
+                await stream.aclose()
+                raise
+
+        async def start(routed_model, route):
+            model, text = await self._bind(routed_model, route, prompt, prefix, prefix_cache)
+            try:
+                return await first_piece(model, text)
+            except api_errors().NotFound:
+                if model is routed_model:
+                    raise
+                # Nothing has been sent yet, so the stream can restart inline
+                prefix_cache.invalidate(prefix_cache.key_for(prefix), route)
+                return await first_piece(routed_model, f"{prefix}\n{prompt}")
+
+        yield await self._call(start, _estimate_tokens(prompt if prefix is None else f"{prefix}\n{prompt}"))
+        async for piece in stream:
+            yield piece
+
+    async def _stream(self, model, prompt, **kwargs):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        finished = object()
+
+        def produce():
+            try:
+                response = model.generate_content(prompt, stream=True, **kwargs)
+                produced_text = False
+                for chunk in response:
+                    try:
+                        text = chunk.text
+                    except ValueError: # Chunk without text parts (e.g. only finish metadata)
+                        continue
+                    if text:
+                        produced_text = True
+                        loop.call_soon_threadsafe(queue.put_nowait, text)
+                if not produced_text:
+                    feedback = getattr(response, "prompt_feedback", None)
+                    raise ResponseBlocked(getattr(feedback, "block_reason", None) or "Unknown")
+            except BaseException as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+            else:
+                loop.call_soon_threadsafe(queue.put_nowait, finished)
+
+        async with self._get_semaphore():
+            self.in_flight += 1
+            try:
+                loop.run_in_executor(self._executor, produce)
+                while True:
+                    item = await queue.get()
+                    if item is finished:
+                        break
+                    if isinstance(item, BaseException):
+                        raise item
+                    yield item
+            finally:
+                self.in_flight -= 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
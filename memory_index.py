@@ -0,0 +1,215 @@
+"""Relevance-ranked retrieval over each user's full message history.
+
+Every remembered message is added to a per-user BM25 index kept on disk in
+three append-only files under ``<directory>/<user_id>/``:
+
+- ``text.bin``: the memory lines, UTF-8, back to back
+- ``docs.bin``: fixed-size records ``(offset, size, length)`` per message
+- ``postings.bin``: fixed-size records ``(doc, term hash, term frequency)``
+
+Fixed-size records mean the files can be opened with ``numpy.memmap``
+without parsing, so a large history "loads" instantly; adding a message is
+three small appends. Scoring is vectorized BM25 over the postings. All disk
+work runs on the index's own worker thread.
+
+Appends hold a per-user file lock, and a mapping is refreshed when
+``docs.bin`` has grown, so several bot processes (a sharded deployment) can
+share the index directory.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import os
+import re
+import zlib
+
+import numpy as np
+
+from memory_store import MemoryEntry, parse_memory_line
+from shared_state import file_lock
+
+DOC_DTYPE = np.dtype([('offset', '<u8'), ('size', '<u4'), ('length', '<u4')])
+POSTING_DTYPE = np.dtype([('doc', '<u4'), ('term', '<u4'), ('tf', '<u2')])
+
+_WORDS = re.compile(r'\w+')
+_STOPWORDS = frozenset(
+    'a an and are as at be but by do for from how i if in is it me my of on or so that the this to '
+    'was we what with you your'.split())
+
+
+def tokenize(text):
+    return [word for word in _WORDS.findall(text.lower()) if word not in _STOPWORDS]
+
+
+def term_hash(term):
+    return zlib.crc32(term.encode('utf-8'))
+
+
+def _load(path, dtype):
+    """Memory-maps a record file (empty files map to an empty array)."""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    count = os.path.getsize(path) // dtype.itemsize # Ignore a torn trailing record
+    return np.memmap(path, dtype=dtype, mode='r', shape=(count,))
+
+
+class UserIndex:
+    """One user's on-disk index."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._maps = None
+        self._docs_size = 0
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @property
+    def exists(self):
+        return os.path.exists(self._path('docs.bin'))
+
+    def _mapped(self):
+        docs_path = self._path('docs.bin')
+        size = os.path.getsize(docs_path) if os.path.exists(docs_path) else 0
+        if size != self._docs_size:
+            self._maps = None # Grown by another process
+        if self._maps is None:
+            self._docs_size = size
+            self._maps = (
+                _load(self._path('docs.bin'), DOC_DTYPE),
+                _load(self._path('postings.bin'), POSTING_DTYPE),
+                self._path('text.bin'),
+            )
+        return self._maps
+
+    def add_many(self, lines, only_if_missing=False):
+        """Appends memory lines to the index (``only_if_missing``: unless it already exists)."""
+        os.makedirs(self.directory, exist_ok=True)
+        with file_lock(self._path('write.lock')):
+            if only_if_missing and self.exists:
+                return
+            self._append(lines)
+
+    def _append(self, lines):
+        docs, _, _ = self._mapped()
+        doc_number = len(docs)
+        text_path = self._path('text.bin')
+        offset = os.path.getsize(text_path) if os.path.exists(text_path) else 0
+        doc_records = np.zeros(len(lines), dtype=DOC_DTYPE)
+        posting_chunks = []
+        text_parts = []
+        for index, line in enumerate(lines):
+            encoded = line.encode('utf-8')
+            counts = collections.Counter(term_hash(term) for term in tokenize(line))
+            doc_records[index] = (offset, len(encoded), sum(counts.values()))
+            postings = np.zeros(len(counts), dtype=POSTING_DTYPE)
+            postings['doc'] = doc_number + index
+            postings['term'] = list(counts.keys())
+            postings['tf'] = np.minimum(list(counts.values()), 65535)
+            posting_chunks.append(postings)
+            text_parts.append(encoded)
+            offset += len(encoded)
+        # Text first, then postings, then docs: a doc record only exists once its data does
+        with open(text_path, 'ab') as file:
+            file.write(b''.join(text_parts))
+        with open(self._path('postings.bin'), 'ab') as file:
+            for postings in posting_chunks:
+                file.write(postings.tobytes())
+        with open(self._path('docs.bin'), 'ab') as file:
+            file.write(doc_records.tobytes())
+        self._maps = None # Re-map lazily with the new sizes
+
+    def search(self, query, top_k, skip_recent=0, k1=1.2, b=0.75):
+        """BM25 top-k over all but the newest ``skip_recent`` messages, best first."""
+        docs, postings, text_path = self._mapped()
+        searchable = len(docs) - skip_recent
+        query_terms = np.unique(np.array([term_hash(term) for term in tokenize(query)], dtype='<u4'))
+        if searchable <= 0 or top_k <= 0 or not len(query_terms) or not len(postings):
+            return []
+        postings = postings[postings['doc'] < len(docs)] # Postings of a torn append have no doc yet
+        selected = postings[np.isin(postings['term'], query_terms)]
+        if not len(selected):
+            return []
+        lengths = docs['length'].astype(np.float64)
+        average_length = max(lengths.mean(), 1.0)
+        terms, document_frequency = np.unique(selected['term'], return_counts=True)
+        idf = np.log(1.0 + (len(docs) - document_frequency + 0.5) / (document_frequency + 0.5))
+        term_idf = idf[np.searchsorted(terms, selected['term'])]
+        tf = selected['tf'].astype(np.float64)
+        doc_length = lengths[selected['doc']]
+        weights = term_idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * doc_length / average_length))
+        scores = np.bincount(selected['doc'], weights=weights, minlength=len(docs))[:searchable]
+
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        results = []
+        with open(text_path, 'rb') as file:
+            for doc in candidates:
+                file.seek(int(docs['offset'][doc]))
+                line = file.read(int(docs['size'][doc])).decode('utf-8', errors='replace')
+                results.append(MemoryEntry(int(doc), *parse_memory_line(line)))
+        return results
+
+    def last_line(self):
+        docs, _, text_path = self._mapped()
+        if not len(docs):
+            return None
+        with open(text_path, 'rb') as file:
+            file.seek(int(docs['offset'][-1]))
+            return file.read(int(docs['size'][-1])).decode('utf-8', errors='replace')
+
+    @property
+    def document_count(self):
+        return len(self._mapped()[0])
+
+
+class MemoryIndex:
+    """Async front end for per-user indexes, with backfill from the memory backend.
+
+    ``history(user_id)`` returns the user's stored entries (oldest first) and
+    is used once to build an index for users who predate it.
+    """
+
+    def __init__(self, directory='config/gptmemory/index', history=None, open_users=256):
+        self.directory = directory
+        self.history = history
+        self.open_users = open_users
+        self._indexes = collections.OrderedDict()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-index")
+
+    def _index(self, user_id):
+        index = self._indexes.get(user_id)
+        if index is None:
+            index = UserIndex(os.path.join(self.directory, user_id))
+            if not index.exists and self.history is not None:
+                lines = [entry.line for entry in self.history(user_id)]
+                index.add_many(lines, only_if_missing=True)
+            self._indexes[user_id] = index
+            while len(self._indexes) > self.open_users:
+                self._indexes.popitem(last=False) # Drops the memmaps; files stay on disk
+        else:
+            self._indexes.move_to_end(user_id)
+        return index
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _add(self, user_id, entry):
+        index = self._index(user_id)
+        # A first-time backfill may already contain this entry if its memory write landed first
+        if index.last_line() == entry.line:
+            return
+        index.add_many([entry.line])
+
+    async def add(self, user_id, entry):
+        """Indexes one new memory entry."""
+        await self._run(self._add, user_id, entry)
+
+    async def search(self, user_id, query, top_k=5, skip_recent=0):
+        """Most relevant past entries for ``query``, best first, excluding the newest ``skip_recent``."""
+        return await self._run(lambda: self._index(user_id).search(query, top_k, skip_recent))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,386 @@
+"""Per-user conversation memory.
+
+Memory lives in a pluggable backend (an embedded SQLite database in WAL mode
+by default, or the legacy ``config/gptmemory/<user_id>/memory.ini`` files).
+``MemoryStore`` sits in front of it with an LRU cache of each active user's
+recent window, and runs every backend call on a single worker thread so the
+event loop never touches the disk and writes are applied in order.
+
+Backends also keep one rolling summary per user (see prompt_builder), used
+to carry older context once the recent window no longer fits the prompt.
+
+When several bot processes share the database (a sharded deployment),
+``MemoryStore(shared=True)`` checks a cached window against the backend's
+``version`` (newest message id and summary marker) before using it, and
+reloads it if another process has written for that user since.
+
+Existing memory.ini files are imported into SQLite the first time a user is
+seen, or all at once with ``python memory_store.py --migrate``.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import os
+import sqlite3
+import threading
+
+
+class MemoryEntry(collections.namedtuple('MemoryEntry', 'id timestamp content')):
+    """One remembered user message."""
+    __slots__ = ()
+
+    @property
+    def line(self):
+        """The entry formatted the way memory.ini always stored it."""
+        if not self.timestamp:
+            return f'{self.content}\n'
+        return f'{self.timestamp}: {self.content}\n'
+
+
+def parse_memory_line(line):
+    """Splits a legacy memory.ini line into (timestamp, content)."""
+    line = line.rstrip('\n')
+    timestamp, sep, content = line.partition(': ') # ISO timestamps never contain ': '
+    if not sep:
+        return '', line
+    return timestamp, content
+
+
+class IniFileMemoryBackend:
+    """The original layout: one memory.ini per user, trimmed to ``keep`` lines."""
+
+    def __init__(self, directory='config/gptmemory', keep=20):
+        self.directory = directory
+        self.keep = keep
+
+    def _path(self, user_id):
+        return os.path.join(self.directory, user_id, 'memory.ini')
+
+    def _read(self, user_id):
+        path = self._path(user_id)
+        if not os.path.exists(path):
+            return []
+        with open(path, 'r', encoding='utf-8') as file:
+            return [MemoryEntry(i, *parse_memory_line(line)) for i, line in enumerate(file.readlines(), 1)]
+
+    def recent(self, user_id, limit):
+        return self._read(user_id)[-limit:]
+
+    def history(self, user_id):
+        return self._read(user_id)
+
+    def append(self, user_id, timestamp, content):
+        entries = self._read(user_id)
+        entry = MemoryEntry(len(entries) + 1, timestamp, content)
+        entries = (entries + [entry])[-self.keep:]
+        os.makedirs(os.path.dirname(self._path(user_id)), exist_ok=True)
+        with open(self._path(user_id), 'w', encoding='utf-8') as file:
+            file.writelines(e.line for e in entries)
+        return entry
+
+    def get_summary(self, user_id):
+        path = os.path.join(self.directory, user_id, 'summary.ini')
+        if not os.path.exists(path):
+            return '', ''
+        with open(path, 'r', encoding='utf-8') as file:
+            upto, _, summary = file.read().partition('\n')
+        return summary, upto
+
+    def set_summary(self, user_id, summary, upto):
+        os.makedirs(os.path.join(self.directory, user_id), exist_ok=True)
+        with open(os.path.join(self.directory, user_id, 'summary.ini'), 'w', encoding='utf-8') as file:
+            file.write(f'{upto}\n{summary}')
+
+    def close(self):
+        pass
+
+
+class SQLiteMemoryBackend:
+    """Full message history in one SQLite database (WAL mode).
+
+    Appends are a single indexed INSERT and the recent window is an index range
+    scan, so cost per message does not grow with history length.
+    """
+
+    def __init__(self, path='config/gptmemory/memory.db', legacy_directory='config/gptmemory'):
+        self.path = path
+        self.legacy_directory = legacy_directory
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA busy_timeout=5000')
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                content TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS messages_user_id ON messages (user_id, id);
+            CREATE TABLE IF NOT EXISTS migrated_users (user_id TEXT PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS summaries (
+                user_id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                upto TEXT NOT NULL
+            );
+        """)
+        self._migrated = set()
+
+    def recent(self, user_id, limit):
+        self.migrate_legacy(user_id)
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT id, timestamp, content FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT ?',
+                (user_id, limit)).fetchall()
+        return [MemoryEntry(*row) for row in reversed(rows)]
+
+    def history(self, user_id):
+        """Every stored entry for the user, oldest first."""
+        self.migrate_legacy(user_id)
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT id, timestamp, content FROM messages WHERE user_id = ? ORDER BY id', (user_id,)).fetchall()
+        return [MemoryEntry(*row) for row in rows]
+
+    def append(self, user_id, timestamp, content):
+        self.migrate_legacy(user_id)
+        with self._lock:
+            cursor = self.conn.execute(
+                'INSERT INTO messages (user_id, timestamp, content) VALUES (?, ?, ?)',
+                (user_id, timestamp, content))
+        return MemoryEntry(cursor.lastrowid, timestamp, content)
+
+    def append_versioned(self, user_id, timestamp, content):
+        """Like ``append``, also returning the user's newest message id just before the insert."""
+        self.migrate_legacy(user_id)
+        with self._lock:
+            self.conn.execute('BEGIN IMMEDIATE') # No other process can write in between
+            try:
+                previous = self.conn.execute('SELECT MAX(id) FROM messages WHERE user_id = ?', (user_id,)).fetchone()[0]
+                cursor = self.conn.execute(
+                    'INSERT INTO messages (user_id, timestamp, content) VALUES (?, ?, ?)',
+                    (user_id, timestamp, content))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return MemoryEntry(cursor.lastrowid, timestamp, content), previous
+
+    def version(self, user_id):
+        """(newest message id, summary marker); changes whenever any process writes for the user."""
+        with self._lock:
+            newest = self.conn.execute('SELECT MAX(id) FROM messages WHERE user_id = ?', (user_id,)).fetchone()[0]
+            summary = self.conn.execute('SELECT upto FROM summaries WHERE user_id = ?', (user_id,)).fetchone()
+        return (newest, summary[0] if summary else '')
+
+    def get_summary(self, user_id):
+        """(summary, timestamp of the newest message folded into it)."""
+        with self._lock:
+            row = self.conn.execute('SELECT summary, upto FROM summaries WHERE user_id = ?', (user_id,)).fetchone()
+        return tuple(row) if row else ('', '')
+
+    def set_summary(self, user_id, summary, upto):
+        with self._lock:
+            self.conn.execute(
+                'INSERT INTO summaries (user_id, summary, upto) VALUES (?, ?, ?) '
+                'ON CONFLICT(user_id) DO UPDATE SET summary = excluded.summary, upto = excluded.upto',
+                (user_id, summary, upto))
+
+    def migrate_legacy(self, user_id):
+        """Imports ``<legacy_directory>/<user_id>/memory.ini`` once, then renames it."""
+        if user_id in self._migrated:
+            return
+        legacy_file = os.path.join(self.legacy_directory, user_id, 'memory.ini')
+        with self._lock:
+            done = self.conn.execute('SELECT 1 FROM migrated_users WHERE user_id = ?', (user_id,)).fetchone()
+            if not done and os.path.exists(legacy_file):
+                with open(legacy_file, 'r', encoding='utf-8') as file:
+                    rows = [(user_id, *parse_memory_line(line)) for line in file if line.strip()]
+                self.conn.execute('BEGIN IMMEDIATE')
+                try:
+                    self.conn.executemany('INSERT INTO messages (user_id, timestamp, content) VALUES (?, ?, ?)', rows)
+                    self.conn.execute('INSERT OR IGNORE INTO migrated_users (user_id) VALUES (?)', (user_id,))
+                    self.conn.execute('COMMIT')
+                except Exception:
+                    self.conn.execute('ROLLBACK')
+                    raise
+                os.replace(legacy_file, legacy_file + '.migrated')
+                print(f"Migrated {len(rows)} memory lines for user {user_id} from {legacy_file}")
+            elif not done:
+                self.conn.execute('INSERT OR IGNORE INTO migrated_users (user_id) VALUES (?)', (user_id,))
+        self._migrated.add(user_id)
+
+    def migrate_all(self):
+        """Imports every legacy memory.ini under the legacy directory."""
+        if not os.path.isdir(self.legacy_directory):
+            return 0
+        count = 0
+        for user_id in os.listdir(self.legacy_directory):
+            if os.path.exists(os.path.join(self.legacy_directory, user_id, 'memory.ini')):
+                self.migrate_legacy(user_id)
+                count += 1
+        return count
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+class MemoryStore:
+    """LRU-cached, loop-friendly front end for a memory backend.
+
+    The cache holds up to ``cache_users`` users' last ``window`` entries.
+    A per-user lock keeps read-then-append sequences consistent, and the
+    single worker thread applies backend writes in submission order.
+    With ``shared=True`` (needs a backend with ``version``) cached windows
+    are revalidated on every read.
+    """
+
+    def __init__(self, backend, window=20, cache_users=1024, shared=False):
+        self.backend = backend
+        self.window = window
+        self.cache_users = cache_users
+        self.shared = shared and hasattr(backend, 'version')
+        self._versions = {} # user_id -> backend version the cached window matches (shared mode)
+        self.reloads = 0
+        self._cache = collections.OrderedDict()
+        self._summaries = {} # user_id -> (summary, upto), for users in the cache
+        self._locks = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory")
+        self._pending_writes = set()
+
+    def _lock_for(self, user_id):
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        return lock
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _load(self, user_id):
+        # Version first: a write landing in between only causes one extra reload later
+        version = self.backend.version(user_id) if self.shared else None
+        return self.backend.recent(user_id, self.window), version
+
+    async def _window(self, user_id):
+        window = self._cache.get(user_id)
+        if window is not None and self.shared:
+            version = await self._run(self.backend.version, user_id)
+            if version != self._versions.get(user_id):
+                # Another process wrote for this user; drop the stale window and summary
+                self.reloads += 1
+                del self._cache[user_id]
+                self._summaries.pop(user_id, None)
+                window = None
+        if window is None:
+            entries, version = await self._run(self._load, user_id)
+            window = collections.deque(entries, maxlen=self.window)
+            self._cache[user_id] = window
+            if self.shared:
+                self._versions[user_id] = version
+            while len(self._cache) > self.cache_users:
+                evicted, _ = self._cache.popitem(last=False)
+                self._summaries.pop(evicted, None)
+                self._versions.pop(evicted, None)
+                lock = self._locks.get(evicted)
+                if lock is not None and not lock.locked():
+                    del self._locks[evicted]
+        else:
+            self._cache.move_to_end(user_id)
+        return window
+
+    async def recent(self, user_id):
+        """The user's recent window, oldest first."""
+        async with self._lock_for(user_id):
+            return list(await self._window(user_id))
+
+    async def append(self, user_id, timestamp, content):
+        """Adds a message to the cached window and queues the backend write.
+
+        Returns once the write is queued; the worker thread persists it in order.
+        """
+        async with self._lock_for(user_id):
+            window = await self._window(user_id)
+            write = self.backend.append_versioned if self.shared else self.backend.append
+            future = asyncio.get_running_loop().run_in_executor(self._executor, write, user_id, timestamp, content)
+            window.append(MemoryEntry(None, timestamp, content))
+            self._pending_writes.add(future)
+            future.add_done_callback(self._write_done)
+            if self.shared:
+                future.add_done_callback(functools.partial(self._appended, user_id))
+
+    async def summary(self, user_id):
+        """The user's rolling summary as (summary, upto)."""
+        cached = self._summaries.get(user_id)
+        if cached is None:
+            cached = await self._run(self.backend.get_summary, user_id)
+            if user_id in self._cache:
+                self._summaries[user_id] = cached
+        return cached
+
+    async def set_summary(self, user_id, summary, upto):
+        await self._run(self.backend.set_summary, user_id, summary, upto)
+        if user_id in self._cache:
+            self._summaries[user_id] = (summary, upto)
+        known = self._versions.get(user_id)
+        if known is not None:
+            self._versions[user_id] = (known[0], upto)
+
+    def _appended(self, user_id, future):
+        """Shared mode: our own write keeps the window current unless someone else wrote first."""
+        known = self._versions.get(user_id)
+        if known is None or future.cancelled() or future.exception() is not None:
+            return
+        entry, previous = future.result()
+        if known[0] == previous:
+            self._versions[user_id] = (entry.id, known[1])
+
+    def _write_done(self, future):
+        self._pending_writes.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Error writing memory: {future.exception()}")
+
+    async def flush(self):
+        """Waits until every queued write has reached the backend."""
+        if self._pending_writes:
+            await asyncio.gather(*self._pending_writes, return_exceptions=True)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.backend.close()
+
+
+def create_memory_store(config, window, shared=False):
+    """Builds the MemoryStore configured in config/memory_limit.ini ([LIMIT]).
+
+    ``shared`` is set when other bot processes use the same database.
+    """
+    backend_name = config.get('LIMIT', 'backend', fallback='sqlite').lower()
+    if backend_name == 'ini':
+        backend = IniFileMemoryBackend(keep=window)
+    elif backend_name == 'sqlite':
+        backend = SQLiteMemoryBackend(config.get('LIMIT', 'database', fallback='config/gptmemory/memory.db'))
+    else:
+        raise ValueError(f"Unknown memory backend '{backend_name}' in config/memory_limit.ini")
+    if shared and backend_name != 'sqlite':
+        print("Warning: memory.ini files are not kept consistent between bot processes; use backend = sqlite when sharding.")
+    return MemoryStore(backend, window=window, cache_users=config.getint('LIMIT', 'cache_users', fallback=1024),
+                       shared=shared)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] != ['--migrate']:
+        print("Usage: python memory_store.py --migrate")
+        sys.exit(1)
+    import configparser
+    migration_config = configparser.ConfigParser()
+    migration_config.read('config/memory_limit.ini', encoding='utf-8')
+    store = SQLiteMemoryBackend(migration_config.get('LIMIT', 'database', fallback='config/gptmemory/memory.db'))
+    print(f"Migrated memory.ini files for {store.migrate_all()} users.")
+    store.close()
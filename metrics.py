@@ -0,0 +1,294 @@
+"""Latency and health metrics for the bot, with an optional local HTTP endpoint.
+
+The request handler times each stage (queue wait, memory, prompt assembly,
+Gemini, terminal run, explanation, Discord sends) into per-stage histograms
+and counts notable events (cache hits, blocked replies, timeouts, errors).
+A background task measures event-loop lag: how late a short sleep wakes up,
+which is what every other coroutine waits on when the loop is blocked.
+
+With ``[METRICS] enabled = true`` the numbers are served on
+``http://<host>:<port>/metrics`` in Prometheus text format and as a JSON
+summary (p50/p95/p99 per stage) on ``/metrics.json``; the summary is also
+written to ``dump_path`` on shutdown. Disabled, ``create_metrics`` returns
+``NullMetrics``, whose methods do nothing.
+"""
+import asyncio
+import bisect
+import json
+import os
+import time
+
+# Histogram bucket upper bounds in seconds: 1ms to ~2 minutes, x1.5 apart
+BUCKETS = tuple(round(0.001 * 1.5 ** i, 6) for i in range(30))
+
+
+class Histogram:
+    """Fixed-bucket histogram; quantiles are interpolated within a bucket."""
+    __slots__ = ('counts', 'sum', 'count', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1) # Last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = BUCKETS[index - 1] if index else 0.0
+                upper = BUCKETS[index] if index < len(BUCKETS) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / bucket_count, self.max)
+            seen += bucket_count
+        return self.max
+
+
+class _StageTimer:
+    __slots__ = ('metrics', 'name', 'labels', 'started')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.metrics._observe(self.name, self.labels, time.perf_counter() - self.started)
+        return False
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class Metrics:
+    """In-process counters, histograms and gauges, exported on demand."""
+
+    enabled = True
+
+    def __init__(self, namespace='uniui', host='127.0.0.1', port=9464, loop_lag_interval=0.5, dump_path=None):
+        self.namespace = namespace
+        self.host = host
+        self.port = port
+        self.loop_lag_interval = loop_lag_interval
+        self.dump_path = dump_path
+        self._counters = {} # (name, labels) -> value
+        self._histograms = {} # (name, labels) -> Histogram
+        self._gauges = {} # name -> (func, kind, help)
+        self._help = {}
+        self._server = None
+        self._lag_task = None
+        self.started_at = time.time()
+
+    # --- Recording ---
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + amount
+
+    def _observe(self, name, labels, seconds):
+        key = (name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def observe(self, name, seconds, **labels):
+        self._observe(name, tuple(sorted(labels.items())), seconds)
+
+    def stage(self, stage):
+        """Context manager timing one stage of request handling."""
+        return _StageTimer(self, 'stage_seconds', (('stage', stage),))
+
+    def gauge(self, name, func, help='', kind='gauge'):
+        """Registers a value read at export time (``kind='counter'`` for running totals)."""
+        self._gauges[name] = (func, kind, help)
+
+    # --- Event loop lag ---
+    async def _monitor_loop_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.loop_lag_interval
+            await asyncio.sleep(self.loop_lag_interval)
+            lag = max(0.0, loop.time() - expected)
+            self._observe('event_loop_lag_seconds', (), lag)
+
+    # --- Export ---
+    def prometheus_text(self):
+        prefix = self.namespace + '_'
+        lines = []
+        seen = set()
+
+        def header(name, kind):
+            if name not in seen:
+                seen.add(name)
+                lines.append(f'# TYPE {prefix}{name} {kind}')
+
+        for (name, labels), value in sorted(self._counters.items()):
+            header(name, 'counter')
+            lines.append(f'{prefix}{name}{_label_text(labels)} {value}')
+        for name, (func, kind, help) in sorted(self._gauges.items()):
+            try:
+                value = float(func())
+            except Exception:
+                continue
+            if help:
+                lines.append(f'# HELP {prefix}{name} {help}')
+            header(name, kind)
+            lines.append(f'{prefix}{name} {value}')
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                cumulative += bucket_count
+                lines.append(f'{prefix}{name}_bucket{_label_text(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{prefix}{name}_sum{_label_text(labels)} {histogram.sum}')
+            lines.append(f'{prefix}{name}_count{_label_text(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Counters, gauges and p50/p95/p99 per histogram, as plain data."""
+        histograms = {}
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            label = ','.join(str(value) for _, value in labels)
+            histograms[f'{name}[{label}]' if label else name] = {
+                'count': histogram.count,
+                'mean': round(histogram.sum / histogram.count, 6) if histogram.count else 0.0,
+                'p50': round(histogram.quantile(0.50), 6),
+                'p95': round(histogram.quantile(0.95), 6),
+                'p99': round(histogram.quantile(0.99), 6),
+                'max': round(histogram.max, 6),
+            }
+        gauges = {}
+        for name, (func, _, _) in sorted(self._gauges.items()):
+            try:
+                gauges[name] = func()
+            except Exception as e:
+                gauges[name] = f'error: {e}'
+        return {
+            'uptime_seconds': round(time.time() - self.started_at, 1),
+            'counters': {name + _label_text(labels): value for (name, labels), value in sorted(self._counters.items())},
+            'gauges': gauges,
+            'histograms': histograms,
+        }
+
+    # --- HTTP endpoint ---
+    async def _handle_http(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+                pass # Headers are not needed
+            parts = request_line.decode('latin-1').split()
+            path = parts[1].split('?')[0] if len(parts) > 1 else '/'
+            if path == '/metrics':
+                status, content_type, body = '200 OK', 'text/plain; version=0.0.4', self.prometheus_text()
+            elif path == '/metrics.json':
+                status, content_type, body = '200 OK', 'application/json', json.dumps(self.summary(), default=str)
+            else:
+                status, content_type, body = '404 Not Found', 'text/plain', 'Try /metrics or /metrics.json\n'
+            data = body.encode('utf-8')
+            writer.write(
+                f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(data)}\r\n'
+                f'Connection: close\r\n\r\n'.encode('latin-1') + data)
+            await writer.drain()
+        except Exception as e:
+            print(f"Error serving metrics request: {e}")
+        finally:
+            writer.close()
+
+    async def start(self):
+        """Starts the loop-lag monitor and the HTTP endpoint (idempotent)."""
+        if self._lag_task is None:
+            self._lag_task = asyncio.ensure_future(self._monitor_loop_lag())
+        if self._server is None and self.port:
+            try:
+                self._server = await asyncio.start_server(self._handle_http, self.host, self.port)
+                print(f"Metrics available at http://{self.host}:{self.port}/metrics (and /metrics.json)")
+            except OSError as e:
+                print(f"Could not start the metrics endpoint on {self.host}:{self.port}: {e}")
+                self.port = 0
+
+    def close(self):
+        """Writes the JSON summary to ``dump_path``, if set."""
+        if not self.dump_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.dump_path) or '.', exist_ok=True)
+            with open(self.dump_path, 'w', encoding='utf-8') as file:
+                json.dump(self.summary(), file, indent=2, default=str)
+            print(f"Wrote metrics summary to {self.dump_path}")
+        except OSError as e:
+            print(f"Could not write metrics summary: {e}")
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class NullMetrics:
+    """Drop-in replacement used when metrics are disabled; every call is a no-op."""
+
+    enabled = False
+
+    def inc(self, name, amount=1, **labels):
+        pass
+
+    def observe(self, name, seconds, **labels):
+        pass
+
+    def stage(self, stage):
+        return _NULL_TIMER
+
+    def gauge(self, name, func, help='', kind='gauge'):
+        pass
+
+    async def start(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def create_metrics(config, process_index=0):
+    """Builds Metrics from config/metrics.ini ([METRICS]), or NullMetrics when disabled.
+
+    Each process of a sharded deployment listens on ``port + process_index``
+    and dumps to its own file.
+    """
+    section = 'METRICS'
+    if not config.getboolean(section, 'enabled', fallback=False):
+        return NullMetrics()
+    port = config.getint(section, 'port', fallback=9464)
+    dump_path = config.get(section, 'dump_path', fallback='') or None
+    if process_index and dump_path:
+        root, extension = os.path.splitext(dump_path)
+        dump_path = f'{root}.p{process_index}{extension}'
+    return Metrics(
+        host=config.get(section, 'host', fallback='127.0.0.1'),
+        port=port + process_index if port else 0,
+        loop_lag_interval=config.getfloat(section, 'loop_lag_interval', fallback=0.5),
+        dump_path=dump_path,
+    )
@@ -0,0 +1,204 @@
+"""Token-budgeted prompt assembly with a rolling per-user memory summary.
+
+Each prompt section (system prompt, summary, memory, special instructions,
+user request) gets its own token budget, measured with a cheap local
+estimate. Memory is filled newest-first; entries that no longer fit are not
+silently dropped but handed to a ``SummaryManager``, which folds them into
+the user's rolling summary in the background. The next prompt carries that
+summary instead of the raw lines.
+"""
+import asyncio
+import collections
+import hashlib
+import re
+
+_TOKEN_PIECES = re.compile(r"\w+|[^\w\s]")
+
+
+ENTRY_TOKEN_CACHE_SIZE = 65536
+
+
+def estimate_tokens(text):
+    """Rough token count: one per punctuation mark, ~4 characters per word piece."""
+    return sum((len(piece) + 3) // 4 for piece in _TOKEN_PIECES.findall(text))
+
+
+_entry_tokens = collections.OrderedDict() # digest of a memory line -> estimate
+
+
+def entry_tokens(line):
+    """``estimate_tokens`` for one memory line, cached by a hash of the line.
+
+    Entries that stay in the window are counted once; the cache holds
+    16-byte digests, not the lines themselves.
+    """
+    key = hashlib.blake2b(line.encode('utf-8', 'replace'), digest_size=16).digest()
+    tokens = _entry_tokens.get(key)
+    if tokens is None:
+        tokens = _entry_tokens[key] = estimate_tokens(line)
+        if len(_entry_tokens) > ENTRY_TOKEN_CACHE_SIZE:
+            _entry_tokens.popitem(last=False)
+    else:
+        _entry_tokens.move_to_end(key)
+    return tokens
+
+
+def truncate_to_tokens(text, budget, marker="\n... [truncated]"):
+    """Cuts text down to roughly ``budget`` tokens, keeping the beginning."""
+    if budget <= 0 or estimate_tokens(text) <= budget:
+        return text
+    low, high = 0, len(text)
+    while low < high: # Binary search on length; the estimate grows with length
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low] + marker
+
+
+class PromptBudget:
+    """Per-section token budgets; 0 means unlimited."""
+
+    def __init__(self, system=0, summary=300, memory=1500, modifier=0, request=2000, relevant=600):
+        self.system = system
+        self.summary = summary
+        self.memory = memory
+        self.relevant = relevant
+        self.modifier = modifier
+        self.request = request
+
+    @classmethod
+    def from_config(cls, config):
+        """Reads [PROMPT_BUDGET] from config/ai_config.ini."""
+        section = 'PROMPT_BUDGET'
+        return cls(
+            system=config.getint(section, 'system', fallback=0),
+            summary=config.getint(section, 'summary', fallback=300),
+            memory=config.getint(section, 'memory', fallback=1500),
+            relevant=config.getint(section, 'relevant', fallback=600),
+            modifier=config.getint(section, 'modifier', fallback=0),
+            request=config.getint(section, 'request', fallback=2000),
+        )
+
+
+def fit_memory(entries, budget):
+    """Splits entries (oldest first) into (kept, overflow) so ``kept`` fits the budget.
+
+    Newest entries are kept first; ``overflow`` is the older remainder.
+    """
+    if budget <= 0:
+        return list(entries), []
+    used = 0
+    cut = len(entries)
+    for index in range(len(entries) - 1, -1, -1):
+        cost = entry_tokens(entries[index].line)
+        if used + cost > budget:
+            break
+        used += cost
+        cut = index
+    return list(entries[cut:]), list(entries[:cut])
+
+
+def build_static_prefix(budget, system_prompt, static_instructions=""):
+    """The part of the prompt that is identical across requests (see context_cache).
+
+    ``static_instructions`` are fixed trigger instructions (terminal,
+    manipulation, strawberry) that don't depend on the request.
+    """
+    parts = [truncate_to_tokens(system_prompt, budget.system)]
+    if static_instructions:
+        parts.append(f"\n--- SPECIAL INSTRUCTIONS ---\n{static_instructions}\n--- END SPECIAL INSTRUCTIONS ---")
+    return "\n".join(parts)
+
+
+def build_prompt(budget, user_context, memory_entries, summary, prompt_modifier, user_request_content, user_display_name,
+                 relevant_entries=()):
+    """Assembles the per-request part of the prompt (everything after the static prefix).
+
+    ``user_context`` opens the section (who the user is).
+
+    ``relevant_entries`` are older messages retrieved for this request (see
+    memory_index); they share the ``relevant`` budget, best matches first.
+
+    Returns (prompt, overflow) where ``overflow`` are the memory entries that
+    did not fit and should be summarized.
+    """
+    kept, overflow = fit_memory(memory_entries, budget.memory)
+    full_prompt_parts = [user_context]
+
+    if summary:
+        full_prompt_parts.append(
+            f"\n--- LONG-TERM SUMMARY (Older conversation with {user_display_name}) ---\n"
+            f"{truncate_to_tokens(summary, budget.summary)}\n"
+            f"--- END SUMMARY ---"
+        )
+
+    if relevant_entries:
+        # fit_memory keeps from the end of the list, so reverse to keep the best matches
+        relevant_kept, _ = fit_memory(list(reversed(relevant_entries)), budget.relevant)
+        relevant_kept.sort(key=lambda entry: entry.id) # Shown oldest first, like memory
+        if relevant_kept:
+            full_prompt_parts.append(
+                f"\n--- RELEVANT PAST MESSAGES (Older messages from {user_display_name} related to this request) ---\n"
+                f"{''.join(entry.line for entry in relevant_kept)}"
+                f"--- END RELEVANT PAST MESSAGES ---"
+            )
+
+    if kept:
+        memory_section = (
+            f"\n--- CONVERSATION MEMORY (Recent messages for {user_display_name}, oldest first) ---\n"
+            f"{''.join(entry.line for entry in kept)}"
+            f"--- END MEMORY ---"
+        )
+        full_prompt_parts.append(memory_section)
+
+    if prompt_modifier:
+        full_prompt_parts.append(
+            f"\n--- SPECIAL INSTRUCTIONS ---\n{truncate_to_tokens(prompt_modifier, budget.modifier)}\n--- END SPECIAL INSTRUCTIONS ---")
+
+    full_prompt_parts.append(
+        f"\n--- CURRENT USER REQUEST ---\n{truncate_to_tokens(user_request_content, budget.request)}\n--- END USER REQUEST ---")
+
+    return "\n".join(full_prompt_parts), overflow
+
+
+class SummaryManager:
+    """Folds overflowing memory into each user's rolling summary, off the request path.
+
+    ``summarize(prompt)`` is a coroutine returning the new summary text. At
+    most one summarization runs per user; overflow arriving meanwhile is
+    picked up by the next request.
+    """
+
+    def __init__(self, memory_store, summarize, max_words=150):
+        self.memory_store = memory_store
+        self.summarize = summarize
+        self.max_words = max_words
+        self._running = {}
+
+    def schedule(self, user_id, overflow):
+        if not overflow or user_id in self._running:
+            return
+        task = asyncio.ensure_future(self._update(user_id, overflow))
+        self._running[user_id] = task
+        task.add_done_callback(lambda _: self._running.pop(user_id, None))
+
+    async def _update(self, user_id, overflow):
+        try:
+            summary, upto = await self.memory_store.summary(user_id)
+            new_entries = [entry for entry in overflow if entry.timestamp > upto]
+            if not new_entries:
+                return
+            prompt = (
+                f"TASK: Maintain a running summary of a Discord user's past messages to an assistant. "
+                f"Merge the new messages into the existing summary. Keep facts, preferences and ongoing topics; "
+                f"drop small talk. Reply with the updated summary only, at most {self.max_words} words.\n"
+                f"Existing summary:\n{summary or '(none)'}\n"
+                f"New messages (oldest first):\n{''.join(entry.line for entry in new_entries)}"
+            )
+            new_summary = (await self.summarize(prompt)).strip()
+            if new_summary:
+                await self.memory_store.set_summary(user_id, new_summary, new_entries[-1].timestamp)
+        except Exception as e:
+            print(f"Error updating memory summary for user {user_id}: {e}")
@@ -0,0 +1,184 @@
+"""Response cache with request coalescing.
+
+Replies are cached by a hash of the normalized final prompt plus the
+generation config, with a TTL and an LRU size bound. Identical requests
+that arrive while one is already in flight share that one API call instead
+of each making their own.
+
+With a ``shared`` store (shared_state.SharedState, in sharded deployments)
+local misses are looked up there and new entries are written through, so
+every bot process sees the others' replies. Those SQLite calls can wait on
+another process's write lock, so they run on a worker thread, never on the
+event loop. Coalescing stays per process.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import json
+import re
+import time
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def make_cache_key(prompt, generation_config):
+    """Stable key for (normalized prompt, generation config)."""
+    normalized = _WHITESPACE.sub(' ', prompt).strip().lower()
+    config_part = json.dumps(generation_config or {}, sort_keys=True, default=str)
+    return hashlib.sha256(f'{config_part}\0{normalized}'.encode('utf-8')).hexdigest()
+
+
+class _Abandoned(Exception):
+    """The request computing an in-flight value was cancelled; joined callers retry."""
+
+
+class ResponseCache:
+    """TTL + LRU cache of reply text, with in-flight coalescing and hit/miss counters."""
+
+    def __init__(self, max_entries=1024, ttl=600.0, enabled=True, shared=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled
+        self.shared = shared
+        self._entries = collections.OrderedDict() # key -> (expires_at, value)
+        self._in_flight = {}
+        self._executor = None
+        if shared is not None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-cache")
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key):
+        """Value cached in this process or None (expired entries are dropped)."""
+        if not self.enabled:
+            return None
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def _get_shared(self, key):
+        if self.shared is None or not self.enabled:
+            return None
+        found = await asyncio.get_running_loop().run_in_executor(self._executor, self.shared.cache_get, key)
+        if found is None:
+            return None
+        value, remaining = found
+        self._store(key, value, min(remaining, self.ttl))
+        return value
+
+    async def lookup(self, key):
+        """Like ``get``, falling back to the shared store, and counted as a hit or miss."""
+        value = self.get(key)
+        if value is None:
+            value = await self._get_shared(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Stores locally now; the shared write is queued on the worker thread."""
+        if not self.enabled:
+            return
+        self._store(key, value, self.ttl)
+        if self.shared is not None:
+            future = self._executor.submit(self.shared.cache_put, key, value, self.ttl)
+            future.add_done_callback(self._write_done)
+
+    @staticmethod
+    def _write_done(future):
+        if future.exception() is not None:
+            print(f"Error writing to the shared response cache: {future.exception()}")
+
+    def _store(self, key, value, ttl):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_compute(self, key, compute, cacheable=lambda value: True):
+        """Returns the cached value, joins an identical in-flight call, or runs ``compute()``.
+
+        ``cacheable(value)`` decides whether a fresh result is stored (errors
+        should not be); coalesced callers get the result either way. If the
+        caller doing the work is cancelled, one joined caller takes over.
+        """
+        joined = False
+        while self._in_flight.get(key) is not None:
+            if not joined:
+                self.coalesced += 1
+                joined = True
+            try:
+                return await asyncio.shield(self._in_flight[key])
+            except _Abandoned:
+                continue # The first waiter to wake up starts its own compute(); the rest join it
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        if not self.enabled:
+            self.misses += 1
+            return await compute()
+
+        # Registered before the shared lookup, so identical requests arriving meanwhile join this one
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        computed = False
+        try:
+            value = await self._get_shared(key)
+            if value is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                computed = True
+                value = await compute()
+        except asyncio.CancelledError:
+            # Only this caller was cancelled; don't cancel everyone who joined it
+            future.set_exception(_Abandoned())
+            future.exception()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception() # Mark retrieved so an unjoined failure isn't logged as unhandled
+            raise
+        else:
+            future.set_result(value)
+            if computed and cacheable(value):
+                self.put(key, value)
+            return value
+        finally:
+            del self._in_flight[key]
+
+    def close(self):
+        """Waits for queued shared writes (call before closing the shared store)."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'entries': len(self._entries),
+            'hit_rate': (self.hits + self.coalesced) / lookups if lookups else 0.0,
+        }
+
+
+def create_response_cache(config, shared=None):
+    """Builds the cache configured in config/ai_config.ini ([CACHE])."""
+    return ResponseCache(
+        max_entries=config.getint('CACHE', 'max_entries', fallback=1024),
+        ttl=config.getfloat('CACHE', 'ttl', fallback=600.0),
+        enabled=config.getboolean('CACHE', 'enabled', fallback=True),
+        shared=shared,
+    )
@@ -0,0 +1,236 @@
+"""Fair-share admission and scheduling for slash-command requests.
+
+Requests are deferred right away, then wait here for one of ``max_active``
+slots before any memory, LLM or terminal work starts. Waiting requests are
+kept per lane (chat, terminal), per guild and per user:
+
+- lanes take turns by weight (``chat`` 3 : ``terminal`` 1 by default),
+- within a lane, guilds take turns, each serving up to its weight in a row,
+- within a guild, users take turns, and each user's own requests run in order.
+
+One busy user or guild therefore only delays its own requests. The queue is
+bounded: past ``max_depth`` waiting requests, or ``max_per_user`` requests
+from one user, new requests are rejected at once instead of piling up, and
+requests waiting longer than ``max_wait`` are dropped. Waiting callers get
+their position and an ETA (from the average time a slot is held).
+"""
+import asyncio
+import collections
+import time
+
+
+class QueueFull(Exception):
+    """The request was not admitted (queue full, per-user limit, or waited too long)."""
+
+
+class Ticket:
+    """One request's place in the scheduler."""
+    __slots__ = ('user_id', 'guild_id', 'lane', 'future', 'enqueued_at', 'started_at', 'reported')
+
+    def __init__(self, user_id, guild_id, lane, future):
+        self.user_id = user_id
+        self.guild_id = guild_id
+        self.lane = lane
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.reported = None # Last position sent to the caller
+
+
+class FairScheduler:
+    """Weighted round-robin over lanes, guilds and users with a bounded queue."""
+
+    def __init__(self, max_active=8, max_depth=50, max_per_user=3, lane_weights=None, guild_weights=None,
+                 max_wait=300.0, update_interval=5.0, initial_service_time=10.0):
+        self.max_active = max(1, max_active)
+        self.max_depth = max_depth
+        self.max_per_user = max_per_user
+        lane_weights = lane_weights or {'chat': 3, 'terminal': 1}
+        self.guild_weights = guild_weights or {}
+        self.max_wait = max_wait
+        self.update_interval = update_interval
+        self._lane_cycle = [lane for lane, weight in lane_weights.items() for _ in range(max(1, weight))]
+        # lane -> guild -> user -> waiting tickets
+        self._queues = {lane: collections.OrderedDict() for lane in lane_weights}
+        self._cursor = {'lane': 0, 'credit': {}}
+        self._per_user = collections.Counter() # Waiting + active requests per user
+        self.waiting = 0
+        self.active = 0
+        self.rejected = 0
+        self.expired = 0
+        self.service_time = initial_service_time # Moving average of how long a slot is held
+        self._order = None # Cached simulated dispatch order for position updates
+        self._order_time = 0.0
+
+    def _pick(self, queues, cursor):
+        """Pops the next ticket from ``queues``, advancing ``cursor`` (both may be copies)."""
+        for _ in range(len(self._lane_cycle)):
+            lane = self._lane_cycle[cursor['lane'] % len(self._lane_cycle)]
+            cursor['lane'] += 1
+            guilds = queues[lane]
+            if not guilds:
+                continue
+            guild_id, users = next(iter(guilds.items()))
+            user_id, tickets = next(iter(users.items()))
+            ticket = tickets.popleft()
+            if tickets:
+                users.move_to_end(user_id)
+            else:
+                del users[user_id]
+            credit_key = (lane, guild_id)
+            credit = cursor['credit'].get(credit_key, self.guild_weights.get(guild_id, 1)) - 1
+            if not users:
+                del guilds[guild_id]
+                cursor['credit'].pop(credit_key, None)
+            elif credit <= 0:
+                guilds.move_to_end(guild_id)
+                cursor['credit'].pop(credit_key, None)
+            else:
+                cursor['credit'][credit_key] = credit
+            return ticket
+        return None
+
+    def _dispatch(self):
+        while self.active < self.max_active:
+            ticket = self._pick(self._queues, self._cursor)
+            if ticket is None:
+                break
+            self.waiting -= 1
+            self.active += 1
+            ticket.started_at = time.monotonic()
+            ticket.future.set_result(True)
+        self._order = None
+
+    def _remove(self, ticket):
+        guilds = self._queues[ticket.lane]
+        users = guilds.get(ticket.guild_id)
+        tickets = users.get(ticket.user_id) if users else None
+        if tickets is None or ticket not in tickets:
+            return False
+        tickets.remove(ticket)
+        if not tickets:
+            del users[ticket.user_id]
+        if not users:
+            del guilds[ticket.guild_id]
+        self.waiting -= 1
+        self._per_user[ticket.user_id] -= 1
+        if self._per_user[ticket.user_id] <= 0:
+            del self._per_user[ticket.user_id]
+        self._order = None
+        return True
+
+    def positions(self):
+        """{ticket: number of waiting requests that will start before it}, by simulating the dispatch."""
+        now = time.monotonic()
+        if self._order is None or now - self._order_time >= self.update_interval:
+            queues = {
+                lane: collections.OrderedDict(
+                    (guild_id, collections.OrderedDict((user_id, collections.deque(tickets))
+                                                       for user_id, tickets in users.items()))
+                    for guild_id, users in guilds.items())
+                for lane, guilds in self._queues.items()
+            }
+            cursor = {'lane': self._cursor['lane'], 'credit': dict(self._cursor['credit'])}
+            order = {}
+            while True:
+                ticket = self._pick(queues, cursor)
+                if ticket is None:
+                    break
+                order[ticket] = len(order)
+            self._order = order
+            self._order_time = now
+        return self._order
+
+    def eta(self, position):
+        """Rough seconds until a request ``position`` places back in the queue starts."""
+        return (position // self.max_active + 1) * self.service_time
+
+    async def acquire(self, user_id, guild_id, lane='chat', on_wait=None):
+        """Waits for a slot; returns the ticket to pass to ``release``.
+
+        ``on_wait(position, eta)`` is awaited whenever the request's place
+        in the queue changes. Raises QueueFull if the request is not admitted.
+        """
+        if lane not in self._queues:
+            lane = next(iter(self._queues))
+        if self._per_user[user_id] >= self.max_per_user:
+            self.rejected += 1
+            raise QueueFull(f"You already have {self._per_user[user_id]} requests in progress. Please wait for them to finish.")
+        if self.waiting >= self.max_depth:
+            self.rejected += 1
+            raise QueueFull("The bot is overloaded right now. Please try again in a minute.")
+
+        ticket = Ticket(user_id, guild_id, lane, asyncio.get_running_loop().create_future())
+        self._per_user[user_id] += 1
+        self._queues[lane].setdefault(guild_id, collections.OrderedDict()) \
+            .setdefault(user_id, collections.deque()).append(ticket)
+        self.waiting += 1
+        self._dispatch()
+        try:
+            while not ticket.future.done():
+                waited = time.monotonic() - ticket.enqueued_at
+                if waited >= self.max_wait:
+                    self._remove(ticket)
+                    self.expired += 1
+                    raise QueueFull("Your request waited too long in the queue. Please try again.")
+                position = self.positions().get(ticket)
+                if on_wait is not None and position is not None and position != ticket.reported:
+                    ticket.reported = position
+                    try:
+                        await on_wait(position, self.eta(position))
+                    except Exception as e:
+                        print(f"Error sending queue position update: {e}")
+                if ticket.future.done():
+                    break
+                await asyncio.wait({ticket.future}, timeout=min(self.update_interval, self.max_wait - waited))
+        except BaseException:
+            if not self._remove(ticket) and ticket.started_at is not None:
+                self.release(ticket) # Got the slot just as the caller gave up
+            raise
+        return ticket
+
+    def release(self, ticket):
+        """Frees the ticket's slot and starts the next waiting request."""
+        self.active -= 1
+        self._per_user[ticket.user_id] -= 1
+        if self._per_user[ticket.user_id] <= 0:
+            del self._per_user[ticket.user_id]
+        elapsed = time.monotonic() - ticket.started_at
+        self.service_time = 0.8 * self.service_time + 0.2 * elapsed
+        self._dispatch()
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'waiting': self.waiting,
+            'rejected': self.rejected,
+            'expired': self.expired,
+            'service_time': round(self.service_time, 2),
+        }
+
+
+def _parse_weights(value):
+    """'123:2, 456:3' -> {'123': 2, '456': 3}."""
+    weights = {}
+    for item in value.split(','):
+        name, _, weight = item.strip().partition(':')
+        if name and weight:
+            weights[name.strip()] = int(weight)
+    return weights
+
+
+def create_scheduler(config):
+    """Builds the FairScheduler configured in config/scheduler.ini ([SCHEDULER])."""
+    section = 'SCHEDULER'
+    return FairScheduler(
+        max_active=config.getint(section, 'max_active', fallback=8),
+        max_depth=config.getint(section, 'max_depth', fallback=50),
+        max_per_user=config.getint(section, 'max_per_user', fallback=3),
+        lane_weights={
+            'chat': config.getint(section, 'chat_weight', fallback=3),
+            'terminal': config.getint(section, 'terminal_weight', fallback=1),
+        },
+        guild_weights=_parse_weights(config.get(section, 'guild_weights', fallback='')),
+        max_wait=config.getfloat(section, 'max_wait', fallback=300.0),
+        update_interval=config.getfloat(section, 'update_interval', fallback=5.0),
+    )
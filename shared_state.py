@@ -0,0 +1,170 @@
+"""State shared by the bot processes of a sharded deployment.
+
+With ``launcher.py`` each process runs its own group of shards, so anything
+kept only in memory would differ between them. Per-user memory is already in
+SQLite (memory_store.py); ``SharedState`` is a second SQLite database (WAL
+mode, so readers never wait for the writer) holding what the processes also
+have to agree on:
+
+- ``cache``: response cache entries, so a reply cached by one process is a
+  hit in all of them (``ResponseCache(shared=...)`` reads and writes through)
+- ``quota``: each process's Gemini usage per route over the last minute.
+  ``sync_quota`` publishes this process's numbers and loads the others', so
+  the per-key ``rpm``/``tpm`` limits hold for the deployment as a whole.
+
+``file_lock`` serializes writers of files several processes append to (the
+memory index).
+"""
+import asyncio
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+    import msvcrt
+
+
+class SharedState:
+    """Small cross-process key/value cache and quota table in one SQLite file."""
+
+    def __init__(self, path='config/gptmemory/shared.db', process_id=None, prune_every=500):
+        self.path = path
+        self.process_id = str(process_id if process_id is not None else os.getpid())
+        self.prune_every = prune_every
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA busy_timeout=2000')
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS quota (
+                process TEXT NOT NULL,
+                route TEXT NOT NULL,
+                requests INTEGER NOT NULL,
+                tokens INTEGER NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (process, route)
+            );
+        """)
+        self.errors = 0
+
+    # --- Cache ---
+    def cache_get(self, key):
+        """(value, seconds left) or None. Errors count as a miss; the cache is an optimization."""
+        try:
+            with self._lock:
+                row = self.conn.execute('SELECT value, expires_at FROM cache WHERE key = ?', (key,)).fetchone()
+        except sqlite3.Error as e:
+            self._error('reading the shared cache', e)
+            return None
+        if row is None:
+            return None
+        remaining = row[1] - time.time()
+        return (row[0], remaining) if remaining > 0 else None
+
+    def cache_put(self, key, value, ttl):
+        try:
+            with self._lock:
+                self.conn.execute(
+                    'INSERT INTO cache (key, value, expires_at) VALUES (?, ?, ?) '
+                    'ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at',
+                    (key, value, time.time() + ttl))
+                self._writes += 1
+                if self._writes % self.prune_every == 0:
+                    self.conn.execute('DELETE FROM cache WHERE expires_at < ?', (time.time(),))
+        except sqlite3.Error as e:
+            self._error('writing the shared cache', e)
+
+    # --- Quota ---
+    def exchange_usage(self, usage, window=60.0):
+        """Stores this process's ``{route: (requests, tokens)}`` and returns the other processes' totals.
+
+        Rows not refreshed within ``window`` seconds (a stopped process) are ignored.
+        """
+        now = time.time()
+        totals = {}
+        try:
+            with self._lock:
+                self.conn.execute('BEGIN IMMEDIATE')
+                try:
+                    self.conn.executemany(
+                        'INSERT INTO quota (process, route, requests, tokens, updated_at) VALUES (?, ?, ?, ?, ?) '
+                        'ON CONFLICT(process, route) DO UPDATE SET requests = excluded.requests, '
+                        'tokens = excluded.tokens, updated_at = excluded.updated_at',
+                        [(self.process_id, route, requests, tokens, now) for route, (requests, tokens) in usage.items()])
+                    self.conn.execute('COMMIT')
+                except Exception:
+                    self.conn.execute('ROLLBACK')
+                    raise
+                rows = self.conn.execute(
+                    'SELECT route, SUM(requests), SUM(tokens) FROM quota WHERE process != ? AND updated_at > ? GROUP BY route',
+                    (self.process_id, now - window)).fetchall()
+        except sqlite3.Error as e:
+            self._error('exchanging quota usage', e)
+            return None
+        for route, requests, tokens in rows:
+            totals[route] = (requests or 0, tokens or 0)
+        return totals
+
+    def _error(self, action, error):
+        self.errors += 1
+        if self.errors <= 10 or self.errors % 1000 == 0:
+            print(f"Shared state error while {action}: {error}")
+
+    def close(self):
+        with self._lock:
+            try:
+                self.conn.execute('DELETE FROM quota WHERE process = ?', (self.process_id,))
+            except sqlite3.Error:
+                pass
+            self.conn.close()
+
+
+async def sync_quota(shared, pool, interval=2.0):
+    """Keeps ``pool``'s view of other processes' Gemini usage up to date (runs until cancelled)."""
+    while True:
+        totals = await asyncio.to_thread(shared.exchange_usage, pool.usage())
+        if totals is not None:
+            pool.set_shared_usage(totals)
+        await asyncio.sleep(interval)
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Exclusive lock on ``path`` (created if needed) across processes."""
+    with open(path, 'a+b') as file:
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        else:
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+            else:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def create_shared_state(config, process_index=0):
+    """SharedState from config/sharding.ini ([SHARDING]), or None when sharding is off."""
+    if not config.getboolean('SHARDING', 'enabled', fallback=False):
+        return None
+    return SharedState(
+        config.get('SHARDING', 'shared_state', fallback='config/gptmemory/shared.db'),
+        process_id=f'{process_index}:{os.getpid()}',
+    )
@@ -0,0 +1,289 @@
+"""Pool of warm, long-lived shell sessions for terminal mode.
+
+Starting PowerShell for every command often costs more than the command
+itself. A ``ShellPool`` keeps a few shells running and feeds them commands
+over stdin. Each command is framed by a random sentinel that the shell
+prints to stdout (with the exit code) and stderr once the command finishes,
+so output can be read back without closing the pipes.
+
+In bash each command runs in a subshell of the session, so ``exit``,
+``set -e``, exported variables and function definitions end with the
+command instead of breaking or leaking into the session. PowerShell runs
+it in a child scope. Sessions are recycled after ``max_commands``
+commands, and immediately on a timeout, a broken frame or an unexpected
+exit. Without user affinity, every command starts in the session's initial
+directory (like a fresh process would); with it, a user keeps getting the
+same idle session, so ``cd`` persists between their commands.
+"""
+import asyncio
+import base64
+import os
+import tempfile
+import uuid
+
+from terminal_exec import (
+    CommandResult, CommandTimeout, READ_CHUNK, decode_output, kill_process_group,
+    process_group_kwargs, resolve_shell,
+)
+
+SESSION_ARGV = {
+    'bash': ['bash', '--noprofile', '--norc', '-s'],
+    'powershell': ['powershell', '-NoLogo', '-NoProfile', '-NonInteractive', '-ExecutionPolicy', 'Bypass', '-Command', '-'],
+    'pwsh': ['pwsh', '-NoLogo', '-NoProfile', '-NonInteractive', '-Command', '-'],
+}
+
+
+class SessionBroken(Exception):
+    """The shell exited or its output framing could not be read."""
+
+
+def _quote_powershell(text):
+    return "'" + text.replace("'", "''") + "'"
+
+
+def _quote_bash(text):
+    return "'" + text.replace("'", "'\\''") + "'"
+
+
+def build_script(shell, command, sentinel, reset_directory=None, directory_file=None):
+    """One stdin line (bash: a few lines) that runs ``command`` and prints the frame markers.
+
+    With ``directory_file`` (bash), the subshell's final directory is written
+    there and the session changes to it, so ``cd`` carries over.
+    """
+    if shell == 'bash':
+        delimiter = f'END_{sentinel}'
+        reset = f'cd {_quote_bash(reset_directory)}\n' if reset_directory else ''
+        keep, restore = '', ''
+        if directory_file:
+            reset += f'__uniui_dir_file={_quote_bash(directory_file)}\n'
+            keep = """trap 'builtin printf %s "$PWD" > "$__uniui_dir_file"' EXIT; """
+            restore = ("""IFS= read -r -d '' __uniui_dir < "$__uniui_dir_file"; """
+                       """[ -n "$__uniui_dir" ] && builtin cd -- "$__uniui_dir" 2>/dev/null; : > "$__uniui_dir_file"\n""")
+        # The command is read through a heredoc and eval'd in a subshell with stdin detached;
+        # the framing runs in the session itself, where the command cannot redefine anything
+        return (
+            f"{reset}IFS= read -r -d '' __uniui_cmd <<'{delimiter}'\n{command}\n{delimiter}\n"
+            f'( {keep}eval "$__uniui_cmd" ) </dev/null\n'
+            f"__uniui_rc=$?\n{restore}"
+            f"builtin printf '\\n{sentinel} %d\\n' \"$__uniui_rc\"; builtin printf '\\n{sentinel}\\n' >&2\n"
+        )
+    encoded = base64.b64encode(command.encode('utf-8')).decode('ascii')
+    reset = f'Set-Location -LiteralPath {_quote_powershell(reset_directory)}; ' if reset_directory else ''
+    # Single line: PowerShell's `-Command -` runs stdin line by line
+    return (
+        f"{reset}$Error.Clear(); $global:LASTEXITCODE = 0; "
+        f"try {{ & {{ Invoke-Expression ([Text.Encoding]::UTF8.GetString([Convert]::FromBase64String('{encoded}'))) }} "
+        f"| Out-String -Width 200 | ForEach-Object {{ [Console]::Out.Write($_) }} }} "
+        f"catch {{ [Console]::Error.WriteLine($_) }}; "
+        f"$__rc = if ($LASTEXITCODE) {{ $LASTEXITCODE }} elseif ($Error.Count) {{ 1 }} else {{ 0 }}; "
+        f"[Console]::Out.Write(\"`n{sentinel} $__rc`n\"); [Console]::Out.Flush(); "
+        f"[Console]::Error.Write(\"`n{sentinel}`n\"); [Console]::Error.Flush()\n"
+    )
+
+
+async def _read_frame(stream, marker, limit):
+    """Reads until ``marker``; keeps at most ``limit`` bytes before it.
+
+    Returns (kept, dropped, bytes after the marker).
+    """
+    kept = bytearray()
+    dropped = 0
+    pending = b''
+
+    def keep(data):
+        nonlocal dropped
+        room = limit - len(kept)
+        if room > 0:
+            kept.extend(data[:room])
+        dropped += max(0, len(data) - max(room, 0))
+
+    while True:
+        chunk = await stream.read(READ_CHUNK)
+        if not chunk:
+            raise SessionBroken("shell exited before finishing the command")
+        pending += chunk
+        index = pending.find(marker)
+        if index != -1:
+            keep(pending[:index])
+            return kept, dropped, pending[index + len(marker):]
+        # Everything except a possible partial marker at the end is command output
+        safe = len(pending) - len(marker) + 1
+        if safe > 0:
+            keep(pending[:safe])
+            pending = pending[safe:]
+
+
+class ShellSession:
+    """One running shell that executes framed commands sequentially."""
+
+    def __init__(self, shell, directory, keep_directory=False):
+        self.shell = shell
+        self.directory = directory
+        self.keep_directory = keep_directory
+        self.directory_file = None # bash: where each command's subshell leaves its final directory
+        self.process = None
+        self.commands_run = 0
+        self.owner = None
+
+    async def start(self):
+        if self.keep_directory and self.shell == 'bash':
+            handle, self.directory_file = tempfile.mkstemp(prefix='uniui_cwd_')
+            os.close(handle)
+        self.process = await asyncio.create_subprocess_exec(
+            *SESSION_ARGV[self.shell],
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=self.directory,
+            **process_group_kwargs(),
+        )
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def run(self, command, max_output_bytes, reset_directory=None):
+        sentinel = f'__UNIUI_{uuid.uuid4().hex}__'
+        self.process.stdin.write(build_script(self.shell, command, sentinel, reset_directory, self.directory_file).encode('utf-8'))
+        await self.process.stdin.drain()
+        self.commands_run += 1
+
+        async def read_stdout():
+            kept, dropped, rest = await _read_frame(self.process.stdout, f'\n{sentinel} '.encode(), max_output_bytes)
+            while b'\n' not in rest:
+                chunk = await self.process.stdout.read(64)
+                if not chunk:
+                    raise SessionBroken("shell exited while reporting the exit code")
+                rest += chunk
+            try:
+                returncode = int(rest.split(b'\n', 1)[0].strip())
+            except ValueError:
+                raise SessionBroken("could not parse the command's exit code") from None
+            return kept, dropped, returncode
+
+        (stdout, stdout_dropped, returncode), (stderr, stderr_dropped, _) = await asyncio.gather(
+            read_stdout(), _read_frame(self.process.stderr, f'\n{sentinel}\n'.encode(), max_output_bytes))
+        return CommandResult(
+            returncode,
+            decode_output(bytes(stdout), stdout_dropped),
+            decode_output(bytes(stderr), stderr_dropped),
+            bool(stdout_dropped or stderr_dropped),
+        )
+
+    async def close(self):
+        if self.directory_file:
+            try:
+                os.remove(self.directory_file)
+            except OSError:
+                pass
+        if self.process is None:
+            return
+        if self.process.stdin and not self.process.stdin.is_closing():
+            self.process.stdin.close()
+        await kill_process_group(self.process)
+
+
+class ShellPool:
+    """Fixed-size pool of warm ShellSessions."""
+
+    def __init__(self, shell='auto', size=2, max_commands=100, user_affinity=False, directory=None):
+        self.shell = resolve_shell(shell)
+        self.size = max(1, size)
+        self.max_commands = max_commands
+        self.user_affinity = user_affinity
+        self.directory = directory or os.getcwd()
+        self._idle = []
+        self._available = None
+        self._started = False
+        self._start_lock = None
+        self._replacements = set()
+        self.recycled = 0
+
+    async def start(self):
+        """Starts ``size`` sessions (idempotent)."""
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if self._started:
+                return
+            self._available = asyncio.Condition()
+            sessions = await asyncio.gather(*(self._spawn() for _ in range(self.size)))
+            self._idle.extend(sessions)
+            self._started = True
+            print(f"Started {self.size} warm {self.shell} sessions.")
+
+    async def _spawn(self):
+        session = ShellSession(self.shell, self.directory, self.user_affinity)
+        await session.start()
+        return session
+
+    async def _acquire(self, user_id):
+        async with self._available:
+            while not self._idle:
+                await self._available.wait()
+            if self.user_affinity:
+                for session in self._idle:
+                    if session.owner == user_id:
+                        self._idle.remove(session)
+                        return session
+                # Prefer a session nobody is pinned to, so other users keep theirs
+                self._idle.sort(key=lambda s: s.owner is not None)
+            return self._idle.pop(0)
+
+    async def _release(self, session):
+        async with self._available:
+            self._idle.append(session)
+            self._available.notify()
+
+    def _replace(self, session):
+        """Recycles a session in the background and returns a fresh one to the pool."""
+        self.recycled += 1
+
+        async def replace():
+            await session.close()
+            try:
+                fresh = await self._spawn()
+            except Exception as e:
+                print(f"Failed to start a replacement {self.shell} session: {e}")
+                await asyncio.sleep(1)
+                self._replace(session)
+                return
+            await self._release(fresh)
+
+        task = asyncio.ensure_future(replace())
+        self._replacements.add(task)
+        task.add_done_callback(self._replacements.discard)
+
+    async def run(self, command, user_id=None, timeout=30.0, max_output_bytes=65536):
+        """Runs a command on a pooled session; same contract as TerminalExecutor.run."""
+        await self.start()
+        session = await self._acquire(user_id)
+        # A session changing hands (or any command without affinity) starts from the initial directory
+        reset = None
+        if not self.user_affinity or session.owner != user_id:
+            reset = self.directory
+        session.owner = user_id if self.user_affinity else None
+        try:
+            result = await asyncio.wait_for(session.run(command, max_output_bytes, reset), timeout)
+        except asyncio.TimeoutError:
+            self._replace(session)
+            raise CommandTimeout(timeout) from None
+        except (SessionBroken, ConnectionError) as e:
+            print(f"Shell session failed ({e}); recycling it.")
+            self._replace(session)
+            return CommandResult(1, '', f"The shell session ended unexpectedly: {e}", False)
+        except BaseException:
+            self._replace(session)
+            raise
+        if session.commands_run >= self.max_commands or not session.alive:
+            self._replace(session)
+        else:
+            await self._release(session)
+        return result
+
+    async def close(self):
+        for task in list(self._replacements):
+            await task
+        sessions, self._idle = self._idle, []
+        await asyncio.gather(*(session.close() for session in sessions))
@@ -0,0 +1,70 @@
+"""Progressive Discord replies for streamed AI output.
+
+A ``ProgressiveReply`` collects streamed text and keeps a set of Discord
+messages in sync with it: the current message is edited as text arrives,
+and once the text crosses the 2000-char limit it rolls over into new
+messages using the same splitting rules as normal replies.
+"""
+import time
+
+
+class ProgressiveReply:
+    """Keeps Discord messages in sync with a growing block of text.
+
+    ``send(content, index)`` must be a coroutine returning the sent message
+    (something with an async ``edit(content=...)``). ``split`` turns the full
+    text into message-sized chunks. Edits are debounced to at most one flush
+    per ``edit_interval`` seconds; if a flush itself was slow (Discord made us
+    wait on a rate limit), the interval backs off until flushes are cheap again.
+    """
+
+    def __init__(self, send, split, edit_interval=1.0, max_interval=5.0):
+        self.send = send
+        self.split = split
+        self.base_interval = edit_interval
+        self.edit_interval = edit_interval
+        self.max_interval = max_interval
+        self.text = ""
+        self.messages = []
+        self.sent_contents = []
+        self._last_flush = 0.0
+        self._dirty = False
+
+    @property
+    def sent_any(self):
+        return bool(self.messages)
+
+    async def feed(self, piece):
+        """Adds a streamed piece and flushes if the debounce interval has passed."""
+        self.text += piece
+        self._dirty = True
+        if time.monotonic() - self._last_flush >= self.edit_interval:
+            await self.flush()
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+        started = time.monotonic()
+        for index, chunk in enumerate(self.split(self.text)):
+            if index < len(self.messages):
+                if self.sent_contents[index] != chunk:
+                    await self.messages[index].edit(content=chunk)
+                    self.sent_contents[index] = chunk
+            else:
+                self.messages.append(await self.send(chunk, index))
+                self.sent_contents.append(chunk)
+        self._last_flush = time.monotonic()
+
+        # Rate-limit aware debounce: discord.py sleeps through 429s inside the
+        # request, so a slow flush means we are editing too often.
+        elapsed = self._last_flush - started
+        if elapsed > self.edit_interval:
+            self.edit_interval = min(self.max_interval, self.edit_interval * 2)
+        elif self.edit_interval > self.base_interval:
+            self.edit_interval = max(self.base_interval, self.edit_interval / 2)
+
+    async def finish(self):
+        """Final flush; returns the chunks as they now appear in Discord."""
+        await self.flush()
+        return list(self.sent_contents)
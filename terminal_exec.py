@@ -0,0 +1,186 @@
+"""Async execution engine for terminal mode.
+
+Commands run as asyncio subprocesses, so a slow command never blocks the
+event loop. A global limit and a per-user limit bound how many commands run
+at once; stdout/stderr are read incrementally and capped at a fixed number
+of bytes (the rest is drained and discarded); on timeout the whole process
+group is killed, not just the shell.
+"""
+import asyncio
+import collections
+import os
+import platform
+import signal
+import subprocess
+
+CommandResult = collections.namedtuple('CommandResult', 'returncode stdout stderr truncated')
+
+
+class CommandTimeout(Exception):
+    """The command ran longer than the executor's timeout and was killed."""
+
+    def __init__(self, timeout):
+        super().__init__(f"Command execution timed out after {timeout:g} seconds.")
+        self.timeout = timeout
+
+# Shell backends: label shown to users/the AI, code block language, and how to run one command
+SHELLS = {
+    'powershell': ('PowerShell', 'powershell', ['powershell', '-NoProfile', '-ExecutionPolicy', 'Bypass', '-Command']),
+    'pwsh': ('PowerShell', 'powershell', ['pwsh', '-NoProfile', '-NonInteractive', '-Command']),
+    'bash': ('bash', 'bash', ['bash', '-c']),
+}
+
+IS_WINDOWS = platform.system() == 'Windows'
+READ_CHUNK = 4096
+
+
+def resolve_shell(name):
+    """Maps 'auto' to the platform default (PowerShell on Windows, bash elsewhere)."""
+    name = (name or 'auto').strip().lower()
+    if name == 'auto':
+        name = 'powershell' if IS_WINDOWS else 'bash'
+    if name not in SHELLS:
+        raise ValueError(f"Unknown terminal shell '{name}'. Choose one of: auto, {', '.join(SHELLS)}")
+    return name
+
+
+async def _read_capped(stream, limit):
+    """Reads a stream to EOF, keeping at most ``limit`` bytes. Returns (data, bytes_dropped)."""
+    kept = bytearray()
+    dropped = 0
+    while True:
+        chunk = await stream.read(READ_CHUNK)
+        if not chunk:
+            return bytes(kept), dropped
+        room = limit - len(kept)
+        if room > 0:
+            kept += chunk[:room]
+        dropped += max(0, len(chunk) - max(room, 0))
+
+
+def process_group_kwargs():
+    """subprocess kwargs that start the child in its own process group."""
+    if IS_WINDOWS:
+        return {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {'start_new_session': True}
+
+
+async def kill_process_group(process):
+    """Kills the process and everything it started."""
+    if process.returncode is not None:
+        return
+    try:
+        if IS_WINDOWS:
+            killer = await asyncio.create_subprocess_exec(
+                'taskkill', '/F', '/T', '/PID', str(process.pid),
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+            await killer.wait()
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, OSError) as e:
+        print(f"Error killing process group {process.pid}: {e}")
+        process.kill()
+    await process.wait()
+
+
+def decode_output(data, dropped):
+    text = data.decode('utf-8', errors='replace')
+    if dropped:
+        text += f"\n... [output truncated, {dropped} more bytes not shown]"
+    return text
+
+
+class TerminalExecutor:
+    """Runs terminal-mode commands with concurrency limits, output caps and timeouts."""
+
+    def __init__(self, shell='auto', timeout=30.0, max_output_bytes=65536, max_concurrent=4, max_per_user=1, pool=None):
+        self.shell = resolve_shell(shell)
+        self.pool = pool # Optional shell_pool.ShellPool; otherwise one process per command
+        self.shell_label, self.fence_language, self._argv_prefix = SHELLS[self.shell]
+        self.timeout = timeout
+        self.max_output_bytes = max_output_bytes
+        self.max_per_user = max_per_user
+        self._global = asyncio.Semaphore(max_concurrent)
+        self._per_user = {} # user_id -> [semaphore, requests using it]
+        self.running = 0
+
+    async def run(self, command, user_id=None):
+        """Runs one command and returns a CommandResult.
+
+        Raises CommandTimeout if it runs too long, and FileNotFoundError if
+        the configured shell is not installed.
+        """
+        entry = self._per_user.get(user_id)
+        if entry is None:
+            entry = self._per_user[user_id] = [asyncio.Semaphore(self.max_per_user), 0]
+        entry[1] += 1
+        try:
+            # Per-user slot first, so one user's backlog never holds global slots
+            async with entry[0]:
+                async with self._global:
+                    self.running += 1
+                    try:
+                        return await self._execute(command, user_id)
+                    finally:
+                        self.running -= 1
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._per_user[user_id]
+
+    async def start(self):
+        """Warms up the shell session pool, if one is configured."""
+        if self.pool is not None:
+            await self.pool.start()
+
+    async def _execute(self, command, user_id):
+        if self.pool is not None:
+            return await self.pool.run(command, user_id, timeout=self.timeout, max_output_bytes=self.max_output_bytes)
+        process = await asyncio.create_subprocess_exec(
+            *self._argv_prefix, command,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            **process_group_kwargs(),
+        )
+        readers = asyncio.gather(
+            _read_capped(process.stdout, self.max_output_bytes),
+            _read_capped(process.stderr, self.max_output_bytes),
+            process.wait(),
+        )
+        try:
+            (stdout, stdout_dropped), (stderr, stderr_dropped), returncode = await asyncio.wait_for(readers, self.timeout)
+        except asyncio.TimeoutError:
+            await kill_process_group(process)
+            raise CommandTimeout(self.timeout) from None
+        except BaseException:
+            await kill_process_group(process)
+            raise
+        return CommandResult(
+            returncode,
+            decode_output(stdout, stdout_dropped),
+            decode_output(stderr, stderr_dropped),
+            bool(stdout_dropped or stderr_dropped),
+        )
+
+
+def create_terminal_executor(config):
+    """Builds the executor configured in config/terminal.ini ([TERMINAL])."""
+    shell = config.get('TERMINAL', 'shell', fallback='auto')
+    pool = None
+    if config.get('TERMINAL', 'backend', fallback='spawn').lower() == 'pool':
+        from shell_pool import ShellPool # Imported here: shell_pool builds on this module
+        pool = ShellPool(
+            shell=shell,
+            size=config.getint('TERMINAL', 'pool_size', fallback=2),
+            max_commands=config.getint('TERMINAL', 'recycle_after', fallback=100),
+            user_affinity=config.getboolean('TERMINAL', 'user_affinity', fallback=False),
+        )
+    return TerminalExecutor(
+        shell=shell,
+        pool=pool,
+        timeout=config.getfloat('TERMINAL', 'timeout', fallback=30.0),
+        max_output_bytes=config.getint('TERMINAL', 'max_output_bytes', fallback=65536),
+        max_concurrent=config.getint('TERMINAL', 'max_concurrent', fallback=4),
+        max_per_user=config.getint('TERMINAL', 'max_per_user', fallback=1),
+    )
@@ -0,0 +1,132 @@
+"""Terminal mode in one Gemini call where possible.
+
+The classic flow makes two sequential calls: one to turn the request into a
+command, and one to explain whatever the command printed. In plan mode the
+first call returns a JSON plan instead of a bare command:
+
+    {"command": "...", "refusal": null, "purpose": "...",
+     "success_note": "...", "needs_explanation": false}
+
+``purpose`` and ``success_note`` are written before the command runs, so a
+successful command whose output is itself the answer (a file listing, a
+version string) or that prints nothing is reported locally from the plan.
+Common failures (unknown command, missing path, access denied, bad
+parameter, name resolution, refused connection) are explained from a table
+of error signatures. Only output that needs interpreting, or an unfamiliar
+error, costs a second call, and those explanations are cached by
+(command, hash of the result).
+
+A reply with no ``{`` at all is treated as a bare command, so a model that
+ignores the format still works. A reply that looks like JSON but does not
+parse (cut off by ``max_output_tokens``, say) is refused, never executed.
+"""
+import collections
+import hashlib
+import json
+import re
+
+from chunker import code_block
+
+TerminalPlan = collections.namedtuple('TerminalPlan', 'command refusal purpose success_note needs_explanation')
+
+PLAN_GENERATION_CONFIG = {"response_mime_type": "application/json"}
+
+
+def plan_instructions(os_name, shell_label):
+    """Static instructions asking for the JSON plan (keeps the wording of the classic prompt)."""
+    return (
+        "IMPORTANT TASK: You MUST translate the user's request into a single, executable "
+        f"command for the {os_name} terminal ({shell_label}). "
+        "Respond ONLY with a JSON object with these keys:\n"
+        '"command": the raw command text, without markdown code blocks;\n'
+        '"refusal": null, or a short reason if the request is ambiguous, unsafe (e.g., involves deleting files, '
+        'formatting drives, shutting down) or cannot be done with a single command (then "command" is "");\n'
+        '"purpose": one sentence telling the user what the command does;\n'
+        '"success_note": one or two sentences of Discord markdown to show under the output if the command succeeds; '
+        'introduce the output without guessing what it will contain;\n'
+        '"needs_explanation": true only if the user needs the output interpreted to answer their request '
+        '(e.g. a yes/no question or a diagnosis), false if the output itself is the answer.'
+    )
+
+
+def _strip_fences(text):
+    text = text.strip()
+    if text.startswith('```'):
+        text = text.split('\n', 1)[1] if '\n' in text else ''
+        if text.rstrip().endswith('```'):
+            text = text.rstrip()[:-3]
+    return text.strip()
+
+
+def parse_plan(text):
+    """TerminalPlan from the model's reply.
+
+    A reply without any ``{`` is taken as the command itself; one that
+    looks like JSON but is not a valid plan becomes a refusal.
+    """
+    body = _strip_fences(text)
+    start, end = body.find('{'), body.rfind('}')
+    if start == -1:
+        return TerminalPlan(body, None, '', '', True)
+    try:
+        data = json.loads(body[start:end + 1]) if end > start else None
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or not isinstance(data.get('command'), str):
+        return TerminalPlan('', "The command plan could not be read (the reply may have been cut off).", '', '', True)
+    refusal = data.get('refusal')
+    return TerminalPlan(
+        command=_strip_fences(data['command']),
+        refusal=str(refusal).strip() if refusal else None,
+        purpose=str(data.get('purpose') or '').strip(),
+        success_note=str(data.get('success_note') or '').strip(),
+        needs_explanation=bool(data.get('needs_explanation', True)),
+    )
+
+
+# (pattern, explanation); checked in order against stderr. {name} is the first captured group, if any.
+ERROR_SIGNATURES = [
+    (re.compile(r"The term '([^']+)' is not recognized as the name of a cmdlet|(?:^|: )([\w.-]+): (?:command )?not found",
+                re.IGNORECASE | re.MULTILINE),
+     "`{name}` is not a command {shell} knows on this machine. It may not be installed, may not be on the PATH, "
+     "or the name may be misspelled."),
+    (re.compile(r"Cannot find path '([^']+)'|cannot access '([^']+)': No such file or directory|"
+                r"([^\s:]+): No such file or directory", re.IGNORECASE),
+     "The path `{name}` does not exist. Check the spelling, or that it is relative to the bot's current directory."),
+    (re.compile(r"Access to the path '([^']+)' is denied|UnauthorizedAccess|Permission denied|Access is denied",
+                re.IGNORECASE),
+     "Access was denied. The bot's user account does not have permission for this (it may need administrator "
+     "rights, or the file may be in use)."),
+    (re.compile(r"A parameter cannot be found that matches parameter name '([^']+)'|"
+                r"(?:invalid|unrecognized) option (?:-- )?'?-*(\w[\w-]*)'?", re.IGNORECASE),
+     "The command was given an option it does not support (`{name}`). The rest of the command may be fine; "
+     "the option is probably spelled differently in {shell}."),
+    (re.compile(r"No such host is known|Could not resolve host:? ?([\w.-]*)|Name or service not known|"
+                r"Temporary failure in name resolution", re.IGNORECASE),
+     "The host name could not be resolved. Check the address, or that the machine is connected to the internet."),
+    (re.compile(r"Connection refused|Unable to connect to the remote server|actively refused", re.IGNORECASE),
+     "The connection was refused: nothing is listening at that address and port, or a firewall blocks it."),
+]
+
+
+def local_explanation(plan, returncode, stdout, stderr, shell_label, max_lines=40):
+    """An explanation that needs no model call, or None when one is needed."""
+    if returncode == 0:
+        if not stdout:
+            done = "The command ran successfully and printed nothing."
+            return f"{plan.purpose}\n{done}" if plan.purpose else done
+        if plan.needs_explanation or not plan.success_note or len(stdout.splitlines()) > max_lines:
+            return None
+        return f"{code_block(stdout)}\n{plan.success_note}"
+    for pattern, template in ERROR_SIGNATURES:
+        match = pattern.search(stderr or '')
+        if match:
+            name = next((group for group in match.groups() if group), '')
+            return template.format(name=name, shell=shell_label)
+    return None
+
+
+def explanation_key(command, returncode, stdout, stderr):
+    """Cache key for an explanation: the command plus a hash of what it produced."""
+    output_hash = hashlib.sha256(f'{returncode}\0{stdout}\0{stderr}'.encode('utf-8', 'replace')).hexdigest()
+    return hashlib.sha256(f'{command}\0{output_hash}'.encode('utf-8', 'replace')).hexdigest()
@@ -0,0 +1,157 @@
+"""Keyword trigger matching for terminal / manipulation / strawberry phrases.
+
+All phrase lists are compiled into one Aho-Corasick automaton, so a message
+is scanned once no matter how many phrases there are. Categories keep a
+fixed precedence (the first category listed wins), and ``TriggerSet``
+rebuilds the automaton when one of the CSV files changes on disk, swapping
+it in only once the new one is complete.
+"""
+import collections
+import csv
+import os
+import re
+import time
+
+_FOLD_PATTERN = re.compile(r'[\W_]+')
+
+
+def normalize_text(text, fold=False):
+    """Lowercases text; with ``fold`` also turns punctuation/whitespace runs into one space."""
+    text = text.lower()
+    if fold:
+        text = _FOLD_PATTERN.sub(' ', text).strip()
+    return text
+
+
+def load_phrases_from_csv(filepath):
+    """Loads phrases from the first column of a CSV file (skipping the 'Text' header)."""
+    phrases = []
+    try:
+        with open(filepath, 'r', encoding='utf-8') as csvfile:
+            reader = csv.reader(csvfile)
+            phrases = [row[0].lower() for row in reader if row and row[0].strip()] # Store lowercase
+    except FileNotFoundError:
+        print(f"Warning: CSV file not found at {filepath}. Feature might not work.")
+    except Exception as e:
+        print(f"Error reading CSV file {filepath}: {e}")
+    if phrases and phrases[0] == 'text':
+        phrases = phrases[1:]
+    return phrases
+
+
+class AhoCorasick:
+    """Multi-pattern substring automaton; each pattern carries a category bitmask."""
+
+    def __init__(self, patterns):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [0]
+        for pattern, mask in patterns:
+            if not pattern:
+                continue
+            state = 0
+            for ch in pattern:
+                next_state = self._goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][ch] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(0)
+                state = next_state
+            self._out[state] |= mask
+
+        # Breadth-first pass to build failure links and merge outputs along them.
+        # Depth-1 states keep their failure link at the root.
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(ch, 0)
+                self._out[next_state] |= self._out[self._fail[next_state]]
+
+    def scan(self, text, stop_mask=0):
+        """Returns the OR of the masks of every pattern found in ``text``.
+
+        Stops early once any bit of ``stop_mask`` has been found.
+        """
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        found = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found |= out[state]
+                if found & stop_mask:
+                    break
+        return found
+
+
+class TriggerMatcher:
+    """Compiled matcher over ``[(category, phrases), ...]`` in precedence order."""
+
+    def __init__(self, categories, fold=False):
+        self.fold = fold
+        self.names = [name for name, _ in categories]
+        self.phrase_count = sum(len(phrases) for _, phrases in categories)
+        self._automaton = AhoCorasick(
+            (normalize_text(phrase, fold), 1 << index)
+            for index, (_, phrases) in enumerate(categories)
+            for phrase in phrases
+        )
+
+    def match_all(self, message):
+        """Every category whose phrases occur in the message, in precedence order."""
+        found = self._automaton.scan(normalize_text(message, self.fold))
+        return [name for index, name in enumerate(self.names) if found & (1 << index)]
+
+    def match(self, message):
+        """The highest-precedence category found in the message, or None."""
+        found = self._automaton.scan(normalize_text(message, self.fold), stop_mask=1)
+        if not found:
+            return None
+        lowest_bit = (found & -found).bit_length() - 1
+        return self.names[lowest_bit]
+
+
+class TriggerSet:
+    """A TriggerMatcher built from CSV files, rebuilt when any of them changes."""
+
+    def __init__(self, sources, fold=False, check_interval=5.0):
+        self.sources = sources # [(category, csv_path), ...] in precedence order
+        self.fold = fold
+        self.check_interval = check_interval
+        self._mtimes = None
+        self._next_check = 0.0
+        self.matcher = None
+        self.reload_if_changed()
+
+    def _current_mtimes(self):
+        mtimes = []
+        for _, path in self.sources:
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def reload_if_changed(self):
+        self._next_check = time.monotonic() + self.check_interval
+        mtimes = self._current_mtimes()
+        if mtimes == self._mtimes:
+            return False
+        matcher = TriggerMatcher([(name, load_phrases_from_csv(path)) for name, path in self.sources], fold=self.fold)
+        self.matcher, self._mtimes = matcher, mtimes # Swap in only once fully built
+        print(f"Loaded {matcher.phrase_count} trigger phrases from {len(self.sources)} CSV files.")
+        return True
+
+    def match(self, message):
+        if time.monotonic() >= self._next_check:
+            self.reload_if_changed()
+        return self.matcher.match(message)